@@ -1,4 +1,5 @@
 from oscope import *
 from rigol import RigolScope
 from waverunner import Waverunner
+from synthetic import SyntheticScope
 from utils import *
\ No newline at end of file
@@ -0,0 +1,342 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#===========================================================
+#
+# This file is part of PyOscope
+#
+# enetsim.py
+#
+# Copyright (c) 2011 Michael Hadmack (michael.hadmack@gmail.com)
+# This code is distributed under the MIT license
+#
+# Stand-in for a NI ENET/GPIB box with a LeCroy Waverunner
+# attached.  Speaks the same framing as libnienet so EnetLib and
+# Waverunner can be exercised and benchmarked without hardware:
+#
+#   python enetsim.py --port 5000 --points 500k --rate 1e6
+#
+# and then Waverunner("127.0.0.1") as usual.
+#===========================================================
+import SocketServer
+import socket
+import struct
+import threading
+import time
+import numpy as np
+from optparse import OptionParser
+from libnienet import ERR, TIMO, END, RQS, CMPL, EABO, _timeouts
+
+WAVEDESC_LENGTH = 346
+LECROY_EXTRA_POINTS = 2  # the scope sends two more points than MEMORY_SIZE
+
+def parseSize(value):
+    '''Parse LeCroy memory sizes such as 5000, 10K, 500k or 1MA'''
+    value = value.strip().upper().rstrip('A')
+    scale = 1
+    if value.endswith('K'):
+        value, scale = value[:-1], 1000
+    elif value.endswith('M'):
+        value, scale = value[:-1], 1000000
+    return int(float(value)*scale)
+
+class LecroySim(object):
+    '''Emulated LeCroy Waverunner.  write() takes GPIB messages,
+       read() hands out the pending response'''
+    def __init__(self, points=5000, n_chans=4, dt=1e-9, idn=None,
+                 trigger_period=0.01):
+        self.points = points
+        self.n_chans = n_chans
+        self.dt = dt
+        self.idn = idn or "LECROY,WAVERUNNER-2,LCRY0000,SIM"
+        self.vert_gain = 1e-3
+        self.vert_offset = 0.
+        self.word = True        # COMM_FORMAT WORD or BYTE
+        self.hifirst = True     # COMM_ORDER HI or LO
+        self.segments = 0       # SEQUENCE ON/OFF
+        self.segment_period = 1e-4
+        # a new acquisition every trigger_period s, INR bit 0 flags it
+        self.trigger_period = trigger_period
+        self.ine = 0
+        self.sre = 0
+        self._inr_read = time.time()
+        self._out = ""
+        self._samples = {}
+
+    def write(self, message):
+        for command in message.split(';'):
+            command = command.strip()
+            if command:
+                self._command(command)
+
+    def read(self, num):
+        '''Returns (data, end) where end is set once the whole message is out'''
+        data, self._out = self._out[:num], self._out[num:]
+        return data, not self._out
+
+    def _command(self, command):
+        words = command.split(None, 1)
+        head = words[0].upper()
+        arg = words[1] if len(words) > 1 else ''
+        if head == '*IDN?':
+            self._respond("*IDN " + self.idn)
+        elif head in ('MEMORY_SIZE', 'MSIZ'):
+            self.points = parseSize(arg)
+        elif head in ('MEMORY_SIZE?', 'MSIZ?'):
+            self._respond("MSIZ %d" % self.points)
+        elif head in ('COMM_FORMAT', 'CFMT'):
+            self.word = 'BYTE' not in arg.upper()
+        elif head in ('COMM_ORDER', 'CORD'):
+            self.hifirst = not arg.upper().startswith('LO')
+        elif head in ('SEQUENCE', 'SEQ'):
+            args = [a.strip().upper() for a in arg.split(',')]
+            self.segments = int(args[1]) if args[0] == 'ON' else 0
+            if len(args) > 2:
+                self.points = parseSize(args[2])
+        elif head == '*OPC?':
+            self._respond("*OPC 1")
+        elif head == 'INE':
+            self.ine = int(arg)
+        elif head == '*SRE':
+            self.sre = int(arg)
+        elif head == 'INR?':
+            self._respond("INR %d" % self._inr())
+            self._inr_read = time.time()
+        elif head.endswith(':WAVEFORM?') or head.endswith(':WF?'):
+            chan = int(head[1:head.index(':')])
+            self._out += self._waveform(chan, arg.upper() or 'ALL')
+
+    def _inr(self):
+        '''INR bit 0 is set once an acquisition ends after the last INR?'''
+        return int(self.nextAcquisition() <= time.time())
+
+    def nextAcquisition(self):
+        '''Time the next acquisition since the last INR? ends'''
+        if not self.trigger_period:
+            return float('inf')
+        period = self.trigger_period
+        return (int(self._inr_read/period) + 1)*period
+
+    def stb(self):
+        '''Status byte, with RQS when INB is enabled by *SRE'''
+        inb = int(bool(self._inr() & self.ine))
+        return inb | (0x40 if inb & self.sre else 0)
+
+    def nextSrq(self):
+        '''Time SRQ will be asserted, inf if it is not enabled'''
+        if not (self.ine & 1 and self.sre & 1):
+            return float('inf')
+        return self.nextAcquisition()
+
+    def _respond(self, text):
+        self._out += text + "\n"
+
+    def _getSamples(self, chan):
+        '''Trace for chan at the current memory depth and format, cached'''
+        key = (self.points, self.word, self.hifirst, self.segments)
+        cached, data = self._samples.get(chan, (None, None))
+        if cached != key:
+            if self.segments:
+                n = self.points
+            else:
+                n = self.points + LECROY_EXTRA_POINTS
+            i = np.arange(n)
+            data = 2000*np.sin(2*np.pi*chan*i/float(n))
+            data[n/4 + 50*chan:n/2] += 8000
+            if self.segments:
+                # one trace per segment, the pulse walks along
+                data = np.tile(data, (self.segments, 1))
+                for k in range(self.segments):
+                    data[k, n/2:n/2 + k] += 8000
+            if self.word:
+                data = data.astype('>h' if self.hifirst else '<h')
+            else:
+                data = (data/256).astype('b')
+            data = data.tostring()
+            self._samples[chan] = (key, data)
+        return data
+
+    def _descriptor(self, chan, n_data_bytes, n_trigtime=0):
+        e = '>' if self.hifirst else '<'
+        gain = self.vert_gain
+        if self.word:
+            n = n_data_bytes / 2
+        else:
+            n = n_data_bytes
+            gain *= 256
+        desc = bytearray(WAVEDESC_LENGTH)
+        struct.pack_into(e+'16s16shh', desc, 0, "WAVEDESC", "LECROY_2_3",
+                         int(self.word), int(not self.hifirst))
+        struct.pack_into(e+'10i', desc, 36, WAVEDESC_LENGTH, 0, 0, n_trigtime,
+                         0, 0, n_data_bytes, 0, 0, 0)
+        struct.pack_into(e+'16si16s', desc, 76, "LECROYWR2SIM", 0,
+                         "C%d" % chan)
+        struct.pack_into(e+'9i', desc, 116, n, self.points, 0, n - 1, 0, 1,
+                         0, max(self.segments, 1), 1)
+        struct.pack_into(e+'ffffhhfdd', desc, 156, gain, self.vert_offset,
+                         32767*self.vert_gain, -32768*self.vert_gain, 8, 1,
+                         self.dt, -self.points*self.dt/2, 0.)
+        struct.pack_into(e+'48s48sf', desc, 196, "V", "S", 1e-12)
+        struct.pack_into(e+'dBBBBhh', desc, 296, time.time() % 60, 0, 0, 1,
+                         1, 2011, 0)
+        struct.pack_into(e+'h', desc, 344, chan - 1)
+        return str(desc)
+
+    def _trigtimes(self):
+        '''TRIGTIME array: trigger time and offset of each segment'''
+        trig = np.zeros(self.segments, dtype=[('time', 'f8'), ('offset', 'f8')])
+        trig['time'] = np.arange(self.segments)*self.segment_period
+        trig['offset'] = -self.points*self.dt/2
+        e = '>' if self.hifirst else '<'
+        return trig.astype([('time', e+'f8'), ('offset', e+'f8')]).tostring()
+
+    def _waveform(self, chan, part='ALL'):
+        data = self._getSamples(chan)
+        trigtimes = self._trigtimes() if self.segments else ""
+        if part == 'DAT1':
+            block = data
+        elif part == 'DESC':
+            block = self._descriptor(chan, len(data), len(trigtimes))
+        else:
+            block = (self._descriptor(chan, len(data), len(trigtimes)) +
+                     trigtimes + data)
+        return "C%d:WF %s,#9%09d" % (chan, part, len(block)) + block + "\n"
+
+class EnetSimHandler(SocketServer.BaseRequestHandler):
+    '''One connection is one device opened with ibdev'''
+    def handle(self):
+        try:
+            self._serve()
+        except socket.error:
+            pass    # the client dropped the connection, e.g. ibstop
+
+    def _serve(self):
+        server = self.server
+        instrument = server.instrument()
+        tmo = 13
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        while True:
+            cmd = self._recv(12)
+            if len(cmd) < 12:
+                break
+            if server.latency:
+                time.sleep(server.latency)
+            id = ord(cmd[0])
+            if id == 0x23:      # ibwrt
+                count, = struct.unpack('!I', cmd[4:8])
+                self._status(CMPL)
+                message = self._recv(count)
+                instrument.write(message)
+                self._status(CMPL, cnt=count)
+            elif id == 0x16:    # ibrd
+                num, = struct.unpack('!I', cmd[4:8])
+                self._status(CMPL)
+                data, end = instrument.read(num)
+                self._sendData(data)
+                if data:
+                    self._status(CMPL | (END if end else 0), cnt=len(data))
+                else:
+                    self._status(ERR | TIMO | CMPL, err=EABO)
+            elif id == 0x19:    # ibrsp
+                self._status(CMPL, extra=struct.pack('!B', instrument.stb()))
+            elif id == 0x07 and ord(cmd[1]) == 1:  # ibdev
+                tmo = ord(cmd[8])
+                self._status(CMPL)
+            elif id == 0x1f:    # ibtmo
+                tmo = ord(cmd[1])
+                self._status(CMPL)
+            elif id == 0x22:    # ibwait
+                mask, = struct.unpack('!H', cmd[2:4])
+                self._status(self._wait(instrument, mask, _timeouts[tmo]))
+            elif id in (0x0d, 0x0f):  # iblines, ibln
+                self._status(CMPL, extra=struct.pack('!H', 1))
+            else:
+                self._status(CMPL)
+
+    def _wait(self, instrument, mask, timeout):
+        '''ibwait: status once RQS is set or timeout passes'''
+        if not mask & RQS:
+            return CMPL
+        wake = instrument.nextSrq()
+        if timeout is not None:
+            wake = min(wake, time.time() + timeout)
+        delay = min(wake - time.time(), _timeouts[-1])
+        if delay > 0:
+            time.sleep(delay)
+        if instrument.stb() & 0x40:
+            return CMPL | RQS
+        return CMPL | TIMO
+
+    def _recv(self, length):
+        chunks = []
+        while length:
+            s = self.request.recv(length)
+            if not s:
+                break
+            chunks.append(s)
+            length -= len(s)
+        return "".join(chunks)
+
+    def _frag(self, data, flags=0):
+        self.request.sendall(struct.pack('!H H', flags, len(data)) + data)
+
+    def _status(self, sta, err=0, cnt=0, extra=""):
+        self._frag(struct.pack('!H H 4x L', sta, err, cnt) + extra)
+
+    def _sendData(self, data):
+        '''Send data as fragments, throttled to the configured link rate'''
+        server = self.server
+        start = time.time()
+        for i in range(0, len(data), server.frag_size):
+            self._frag(data[i:i+server.frag_size])
+            if server.rate:
+                delay = start + (i + server.frag_size)/server.rate - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+        self.request.sendall(struct.pack('!H H', 1, 0))
+
+class EnetSimServer(SocketServer.ThreadingTCPServer):
+    '''Local TCP server emulating a NI ENET/GPIB box
+       instrument is called to make the device behind each connection,
+       rate is the link speed in bytes/s (None for unthrottled),
+       latency a fixed delay per ENET command in seconds'''
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address=('127.0.0.1', 5000), instrument=LecroySim,
+                 rate=None, latency=0., frag_size=0xfff0):
+        SocketServer.ThreadingTCPServer.__init__(self, address, EnetSimHandler)
+        self.instrument = instrument
+        self.rate = rate and float(rate)
+        self.latency = latency
+        self.frag_size = frag_size
+
+    def getPort(self):
+        return self.server_address[1]
+
+def startServer(port=0, **kwargs):
+    '''Run an EnetSimServer in a background thread.  With port=0 a free
+       port is picked, ask the server for it with getPort()'''
+    server = EnetSimServer(('127.0.0.1', port), **kwargs)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+if __name__ == "__main__":
+    parser = OptionParser()
+    parser.add_option("-p", "--port", type="int", default=5000,
+                      help="TCP port to listen on [default: %default]")
+    parser.add_option("-n", "--points", default="5000",
+                      help="Initial memory size [default: %default]")
+    parser.add_option("-r", "--rate", type="float", default=None,
+                      help="Link speed in bytes/s [default: unthrottled]")
+    parser.add_option("-l", "--latency", type="float", default=0.,
+                      help="Delay per ENET command in s [default: %default]")
+    (options, args) = parser.parse_args()
+
+    points = parseSize(options.points)
+    server = EnetSimServer(('127.0.0.1', options.port),
+                           lambda: LecroySim(points=points),
+                           rate=options.rate, latency=options.latency)
+    print "ENET/GPIB simulator listening on port %d" % options.port
+    server.serve_forever()
@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#===========================================================
+#
+# This file is part of PyOscope
+#
+# ioloop.py
+#
+# Copyright (c) 2011 Michael Hadmack (michael.hadmack@gmail.com)
+# This code is distributed under the MIT license
+#
+# Minimal select() based event loop for generator coroutines
+#===========================================================
+"""
+Lets one thread keep many instruments busy at the same time.
+
+A coroutine is a generator which may yield:
+  (fileobj, READ) or (fileobj, WRITE)  to wait until fileobj is ready
+  Sleep(seconds)                       to resume after a delay
+  another coroutine                    to run it and get back its result
+and finishes with "raise Return(value)" to hand a result to its caller.
+
+Example:
+    loop = IOLoop()
+    tasks = [loop.spawn(scope.grabDataAsync()) for scope in scopes]
+    loop.run()
+"""
+import select
+import sys
+import time
+import types
+
+READ = 'r'
+WRITE = 'w'
+SLEEP = 's'     # wait is (wake up time, SLEEP)
+
+class Return(Exception):
+    '''Raised by a coroutine to return value to its caller'''
+    def __init__(self, value=None):
+        Exception.__init__(self, value)
+        self.value = value
+
+class Sleep(object):
+    '''Yielded by a coroutine to pause it for seconds'''
+    def __init__(self, seconds):
+        self.seconds = seconds
+
+class Task(object):
+    '''Drives one coroutine and the coroutines it yields to'''
+    def __init__(self, coroutine):
+        self._stack = [coroutine]
+        self._value = None
+        self._exc = None
+        self.wait = None
+        self.done = False
+        self.result = None
+        self.error = None
+
+    def step(self):
+        '''Run until the task waits for I/O or finishes'''
+        self.wait = None
+        while self._stack:
+            gen = self._stack[-1]
+            try:
+                if self._exc is not None:
+                    exc, self._exc = self._exc, None
+                    y = gen.throw(*exc)
+                else:
+                    value, self._value = self._value, None
+                    y = gen.send(value)
+            except Return as r:
+                self._stack.pop()
+                self._value = r.value
+            except StopIteration:
+                self._stack.pop()
+            except Exception:
+                self._stack.pop()
+                self._exc = sys.exc_info()
+            else:
+                if isinstance(y, types.GeneratorType):
+                    self._stack.append(y)
+                elif isinstance(y, Sleep):
+                    self.wait = (time.time() + y.seconds, SLEEP)
+                    return
+                else:
+                    self.wait = y
+                    return
+        self.done = True
+        if self._exc is not None:
+            self.error, self._exc = self._exc, None
+        else:
+            self.result = self._value
+
+    def get(self):
+        '''Returns the result of a finished task or raises its exception'''
+        if self.error is not None:
+            raise self.error[0], self.error[1], self.error[2]
+        return self.result
+
+class IOLoop(object):
+    '''Runs many tasks, multiplexing their I/O waits with select()'''
+    def __init__(self):
+        self.tasks = []
+
+    def spawn(self, coroutine):
+        task = Task(coroutine)
+        self.tasks.append(task)
+        return task
+
+    def run(self, timeout=None):
+        '''Run until all spawned tasks are finished.  Returns False if
+           timeout seconds pass first, the unfinished tasks are kept'''
+        if timeout is not None:
+            deadline = time.time() + timeout
+        while True:
+            for task in self.tasks:
+                if task.wait is None and not task.done:
+                    task.step()
+            self.tasks = [t for t in self.tasks if not t.done]
+            if not self.tasks:
+                return True
+            remaining = None
+            if timeout is not None:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+            wakeups = [t.wait[0] for t in self.tasks if t.wait[1] == SLEEP]
+            if wakeups:
+                wait = max(min(wakeups) - time.time(), 0)
+                if remaining is None or wait < remaining:
+                    remaining = wait
+            rlist = [t.wait[0] for t in self.tasks if t.wait[1] == READ]
+            wlist = [t.wait[0] for t in self.tasks if t.wait[1] == WRITE]
+            r, w, x = select.select(rlist, wlist, [], remaining)
+            now = time.time()
+            for task in self.tasks:
+                fo, event = task.wait
+                if ((event == READ and fo in r) or (event == WRITE and fo in w) or
+                    (event == SLEEP and fo <= now)):
+                    task.step()
+
+def run(coroutine, timeout=None):
+    '''Run a single coroutine to completion and return its result'''
+    loop = IOLoop()
+    task = loop.spawn(coroutine)
+    if not loop.run(timeout):
+        raise IOError("coroutine timed out after %g s" % timeout)
+    return task.get()
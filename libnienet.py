@@ -27,38 +27,128 @@
 # TODO: 
 #
 #  * all the _not_impl()s
-#  * non-blocking IO
 
-import socket, sys
+import socket, sys, threading, time
+from bisect import bisect
 from struct import *
-
-#debug = ["io", "ignore_not_impl"] # "dummy_io", "rw"
+import ioloop
+from ioloop import Return, READ, WRITE
+
+# ibsta bits
+ERR  = 0x8000
+TIMO = 0x4000
+END  = 0x2000
+SRQI = 0x1000
+RQS  = 0x0800
+CMPL = 0x0100
+LOK  = 0x0080
+REM  = 0x0040
+CIC  = 0x0020
+ATN  = 0x0010
+TACS = 0x0008
+LACS = 0x0004
+DTAS = 0x0002
+DCAS = 0x0001
+
+# iberr codes
+EABO = 6
+
+# tmo codes T10us .. T1000s in seconds, 0 is no timeout
+_timeouts = [None, 10e-6, 30e-6, 100e-6, 300e-6, 1e-3, 3e-3, 10e-3, 30e-3,
+  100e-3, 300e-3, 1., 3., 10., 30., 100., 300., 1000.]
+
+# seconds ibstop() lets a pending transfer run out before reconnecting
+STOP_TIMEOUT = 0.1
+
+def tmoCode(seconds):
+  """Smallest tmo code which waits at least seconds, 0 for None"""
+  if seconds is None:
+    return 0
+  for code in range(1, len(_timeouts)):
+    if _timeouts[code] >= seconds:
+      return code
+  return len(_timeouts) - 1
+
+#debug = ["ignore_not_impl"] # "dummy_io"
 debug = ["ignore_not_impl"]
 
-def _dbg(f, name=None):
-  if not name:
-    name = f.__name__
-  def wrap(self, *a, **k):
-    print "DBG: %s: enter: %s %s" % (name, `a`, `k`),
-    r = f(self, *a, **k)
-    print "exit: %s" % `r`
-    return r
-  wrap._dummy = True
-  return wrap
-
 def _not_impl(name):
   def wrap(self, *a, **k):
     if "ignore_not_impl" in debug:
       return None
     else:
-      raise NotImplementedError, "%s not implemented", name
-  return _dbg(wrap, name)
+      raise NotImplementedError, "%s not implemented" % name
+  wrap.__name__ = name
+  return wrap
+
+_cmdnames = {0x03: "ibcac", 0x04: "ibclr", 0x06: "ibconfig", 0x07: "ibdev",
+  0x08: "ibeos", 0x09: "ibeot", 0x0a: "ibgts", 0x0d: "iblines", 0x0f: "ibln",
+  0x10: "ibloc", 0x12: "ibonl", 0x16: "ibrd", 0x18: "ibrsc", 0x19: "ibrsp",
+  0x1c: "ibsic", 0x1f: "ibtmo", 0x20: "ibtrg", 0x22: "ibwait", 0x23: "ibwrt",
+  0x4e: "ibask"}
+
+class EnetStats(object):
+  """Per command counters and latency histograms, see EnetSocket.enableStats().
+
+  Each ENET command is recorded under its name (e.g. "ibrd") with the
+  time from sending it to its status reply, i.e. the GPIB turnaround.
+  The data phases of ibwrt/ibrd are recorded separately as "ibwrt data"
+  and "ibrd data" with the number of bytes moved."""
+
+  # upper histogram bin edges in s, 1-2-5 steps from 10us to 100s
+  edges = [m*10**e for e in range(-5, 2) for m in (1, 2, 5)] + [100.]
+
+  def __init__(self):
+    self.reset()
+
+  def reset(self):
+    self.entries = {}
+
+  def record(self, name, nbytes, elapsed, sta):
+    e = self.entries.get(name)
+    if e is None:
+      e = self.entries[name] = {"count": 0, "bytes": 0, "time": 0.,
+        "max": 0., "errors": 0, "last_sta": 0,
+        "hist": [0]*(len(self.edges) + 1)}
+    e["count"] += 1
+    e["bytes"] += nbytes
+    e["time"] += elapsed
+    if elapsed > e["max"]:
+      e["max"] = elapsed
+    if sta & ERR:
+      e["errors"] += 1
+    e["last_sta"] = sta
+    e["hist"][bisect(self.edges, elapsed)] += 1
+
+  def summary(self):
+    """Returns {name: {count, bytes, time, mean, max, rate, errors,
+    last_sta, hist}} where rate is in bytes/s and hist counts the
+    calls per bin of edges (the last bin is everything above 100s)"""
+    ret = {}
+    for name, e in self.entries.items():
+      e = dict(e, hist=list(e["hist"]))
+      e["mean"] = e["time"]/e["count"]
+      e["rate"] = e["time"] and e["bytes"]/e["time"]
+      ret[name] = e
+    return ret
+
+  def __str__(self):
+    lines = ["%-12s %8s %12s %10s %10s %12s %6s" % ("command", "count",
+      "bytes", "mean (ms)", "max (ms)", "rate (B/s)", "errors")]
+    for name, e in sorted(self.summary().items()):
+      lines.append("%-12s %8d %12d %10.3f %10.3f %12.4g %6d" % (name,
+        e["count"], e["bytes"], 1e3*e["mean"], 1e3*e["max"], e["rate"],
+        e["errors"]))
+    return "\n".join(lines)
 
 class EnetSocket(object):
   def __init__(self, host, port=5000):
     self._host = host
     self._port = port
     self._sock = None
+    self._async = None
+    self.tmo = 13
+    self.stats = None
     self._open()
     self.sta = self.err = self.cnt = 0
 
@@ -70,10 +160,22 @@ class EnetSocket(object):
     return self._sock.send(string)
   
   def _recv(self, length):
-    s = ""
-    while len(s) < length:
-      s += self._sock.recv(length-len(s))
-    return s
+    buf = bytearray(length)
+    self._recv_into(buf)
+    return str(buf)
+
+  def _recv_into(self, buf, length=None):
+    # fill buf in place, no intermediate strings
+    view = memoryview(buf)
+    if length is None:
+      length = len(view)
+    n = 0
+    while n < length:
+      r = self._sock.recv_into(view[n:], length-n)
+      if not r:
+        raise socket.error("connection closed by peer")
+      n += r
+    return n
     
   def _close(self):
     self._sock.close()
@@ -85,12 +187,15 @@ class EnetSocket(object):
     _recv = lambda self, len: raw_input("DBG: < #%s:" % (len))[:len]
     _close = lambda self: None
     
-  if "io" in debug:
-    _open = _dbg(_open)
-    _recv = _dbg(_recv)
-    _send = _dbg(_send)
-    _close = _dbg(_close)
-   
+
+  def enableStats(self, on=True):
+    """Record per command timing in self.stats (an EnetStats).  When off
+    the only cost is a test of self.stats per command."""
+    if not on:
+      self.stats = None
+    elif self.stats is None:
+      self.stats = EnetStats()
+
   _headfmt = "!H H"
 
   def _read_frags(self, many=False):
@@ -107,25 +212,161 @@ class EnetSocket(object):
   def _read(self, many=False):
     return "".join(self._read_frags(many))
 
+  def _read_into(self, buf, many=False):
+    view = memoryview(buf)
+    n = 0
+    while True:
+      header = self._recv(calcsize(self._headfmt))
+      flags, num = unpack(self._headfmt, header)
+      if many and flags:
+        break
+      if n + num > len(view):
+        raise IOError("reply of at least %d bytes overflows %d byte buffer" %
+          (n + num, len(view)))
+      self._recv_into(view[n:n+num])
+      n += num
+      if not many:
+        break
+    return n
+
   def _write(self, string):
     return self._send(string)
   
   _respfmt = "!H H 4x L"
 
-  def _sresp(self):
-    ret = self._read()
+  def _parse_resp(self, ret):
     self.sta, self.err, self.cnt = unpack(self._respfmt, 
       ret[:calcsize(self._respfmt)])
     return ret[calcsize(self._respfmt):]
 
-  def _scmd(self, id, argsfmt="", *args):
+  def _sresp(self):
+    return self._parse_resp(self._read())
+
+  def _pack_cmd(self, id, argsfmt="", *args):
     #assert calcsize("!B" + argsfmt) == 12
     # pad to 12 bytes
     argsfmt += "%dx" % (12 - calcsize("!B" + argsfmt))
-    self._write(pack("!B" + argsfmt, *((id,) + args)))
-    return self._sresp()
+    return pack("!B" + argsfmt, *((id,) + args))
+
+  def _scmd(self, id, argsfmt="", *args):
+    if self._async is not None:
+      raise IOError("asynchronous I/O in progress, complete it with ibwait(CMPL)")
+    if self.stats is not None:
+      t = time.time()
+    self._write(self._pack_cmd(id, argsfmt, *args))
+    ret = self._sresp()
+    if self.stats is not None:
+      self.stats.record(_cmdnames.get(id, "0x%02x" % id), 0, time.time() - t,
+        self.sta)
+    return ret
+
+  def _async_start(self, coroutine):
+    # run the transfer on its own thread, ibwait() collects it
+    if self._async is not None:
+      raise IOError("asynchronous I/O already in progress")
+    result = {}
+    def run():
+      try:
+        result["value"] = ioloop.run(coroutine)
+      except Exception:
+        result["error"] = sys.exc_info()
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    self._async = thread, result
+    self.sta &= ~CMPL
+    thread.start()
+
+  def _async_wait(self, mask):
+    thread, result = self._async
+    if mask & CMPL:
+      thread.join(_timeouts[self.tmo])
+    if thread.is_alive():
+      self.sta &= ~CMPL
+      if mask & CMPL:
+        self.sta |= TIMO
+      return
+    self._async = None
+    if "error" in result:
+      exc = result["error"]
+      raise exc[0], exc[1], exc[2]
+    self.sta |= CMPL
+
+  # Coroutine versions of the transport for ioloop.IOLoop.  The socket
+  # is only touched once select() reports it ready, so one loop can
+  # drive any number of EnetSockets concurrently.
+
+  def _co_send(self, string):
+    view = memoryview(string)
+    n = 0
+    while n < len(view):
+      yield (self._sock, WRITE)
+      n += self._sock.send(view[n:])
+
+  def _co_recv_into(self, buf, length=None):
+    view = memoryview(buf)
+    if length is None:
+      length = len(view)
+    n = 0
+    while n < length:
+      yield (self._sock, READ)
+      r = self._sock.recv_into(view[n:], length-n)
+      if not r:
+        raise socket.error("connection closed by peer")
+      n += r
+    raise Return(n)
+
+  def _co_recv(self, length):
+    buf = bytearray(length)
+    yield self._co_recv_into(buf)
+    raise Return(str(buf))
+
+  def _co_read(self, many=False):
+    frags = []
+    while True:
+      header = yield self._co_recv(calcsize(self._headfmt))
+      flags, num = unpack(self._headfmt, header)
+      if many and flags:
+        break
+      frag = yield self._co_recv(num)
+      frags.append(frag)
+      if not many:
+        break
+    raise Return("".join(frags))
+
+  def _co_read_into(self, buf, many=False):
+    view = memoryview(buf)
+    n = 0
+    while True:
+      header = yield self._co_recv(calcsize(self._headfmt))
+      flags, num = unpack(self._headfmt, header)
+      if many and flags:
+        break
+      if n + num > len(view):
+        raise IOError("reply of at least %d bytes overflows %d byte buffer" %
+          (n + num, len(view)))
+      yield self._co_recv_into(view[n:n+num])
+      n += num
+      if not many:
+        break
+    raise Return(n)
+
+  def _co_sresp(self):
+    ret = yield self._co_read()
+    raise Return(self._parse_resp(ret))
+
+  def _co_scmd(self, id, argsfmt="", *args):
+    if self.stats is not None:
+      t = time.time()
+    yield self._co_send(self._pack_cmd(id, argsfmt, *args))
+    ret = yield self._co_sresp()
+    if self.stats is not None:
+      self.stats.record(_cmdnames.get(id, "0x%02x" % id), 0, time.time() - t,
+        self.sta)
+    raise Return(ret)
 
   def ibdev(self, pad, sad=0, tmo=13, eot=1, eos=0):
+    self.tmo = tmo
+    self._dev_args = (pad, sad, eot, eos)
     if sad != 0: pad |= 0x80
     self._scmd(0x07, "BBBBBBBB", 1, 0,
       0x40 | eot, pad, sad, eos, 0, tmo) #, "\x02\x04\x00")
@@ -144,9 +385,37 @@ class EnetSocket(object):
     # return self.err # prevval
 
   def ibwait(self, mask=0):
+    """With an ibrda()/ibwrta() pending, mask=0 just updates sta and
+    CMPL in mask waits up to the tmo timeout for the transfer to end"""
+    if self._async is not None:
+      return self._async_wait(mask)
     self._scmd(0x22, "B H", 0x54, mask)
 #      "\x20\xe1\x05\x08\xb4\xe0\x05\x08")
 
+  def ibstop(self, timeout=None):
+    """Abort a pending ibrda()/ibwrta().  The reply is already on its way
+    over the connection, so the transfer gets timeout seconds (default
+    STOP_TIMEOUT, short as the caller usually has waited tmo already)
+    to run out.  If it doesn't the connection is reopened with the
+    ibdev() settings.  Sets ERR with err EABO."""
+    if self._async is None:
+      return
+    thread, result = self._async
+    if timeout is None:
+      timeout = STOP_TIMEOUT
+    thread.join(timeout)
+    if thread.is_alive():
+      self._sock.shutdown(socket.SHUT_RDWR)   # ends the transfer's recv
+      thread.join()
+      self._close()
+      self._async = None
+      self._open()
+      pad, sad, eot, eos = self._dev_args
+      self.ibdev(pad, sad, self.tmo, eot, eos)
+    self._async = None
+    self.sta = ERR | CMPL
+    self.err = EABO
+
   def ibrsp(self):
     stb, = unpack("!B", self._scmd(0x19))
 #      "\x63\x16\x40\xc0\x58\x16\x40\x40\x63\x16\x40"))
@@ -185,6 +454,7 @@ class EnetSocket(object):
     
   def ibtmo(self, tmo):
     self._scmd(0x1f, "B", tmo)
+    self.tmo = tmo
 #      "\x00\x00\x20\xe1\x05\x08\xae\xe0\x05\x08")
  
   def ibtrg(self):
@@ -207,27 +477,103 @@ class EnetSocket(object):
     self._scmd(0x1c) 
 #      "\xe1\x05\x08\xb1\xe0\x05\x08\x88\xf5\xff\xbf")
     
+  def _record_data(self, name, nbytes, t):
+    self.stats.record(name, nbytes, time.time() - t, self.sta)
+
   def ibwrt(self, string):
     self._scmd(0x23, "3s I", "\x05\x05\x08", len(string))
 #     "\x00\x54\x00\x00")
+    if self.stats is not None:
+      t = time.time()
     self._write(string)
     self._sresp()
+    if self.stats is not None:
+      self._record_data("ibwrt data", len(string), t)
     
   def ibrd(self, num):
     self._scmd(0x16, "3s I", "\x00\x00\x00", num) 
 #     "\x40\x63\x16\x40")
+    if self.stats is not None:
+      t = time.time()
     ret = self._read(many=True)
     self._sresp()
+    if self.stats is not None:
+      self._record_data("ibrd data", len(ret), t)
     return ret
 
-  if "rw" in debug:
-    ibwrt = _dbg(ibwrt)
-    ibrd = _dbg(ibrd)
+  def ibrd_into(self, buf, num=None):
+    """Like ibrd() but receives straight into the writable byte buffer buf
+    (bytearray, uint8 numpy array, ...) and returns the number of bytes read.
+    Nothing is copied, so buf can be reused from one read to the next."""
+    if num is None:
+      num = len(buf)
+    self._scmd(0x16, "3s I", "\x00\x00\x00", num)
+    if self.stats is not None:
+      t = time.time()
+    ret = self._read_into(buf, many=True)
+    self._sresp()
+    self.cnt = ret
+    if self.stats is not None:
+      self._record_data("ibrd data", ret, t)
+    return ret
+
+  def ibrd_stream(self, num):
+    """Start an ibrd and return an EnetReader handing out the reply as
+    the fragments arrive.  The reader must be closed before the next
+    command is sent."""
+    self._scmd(0x16, "3s I", "\x00\x00\x00", num)
+    return EnetReader(self)
+
+  def ibrda(self, buf, num=None):
+    """Start reading into the byte buffer buf in the background.  Poll
+    with ibwait(0) or wait with ibwait(CMPL), cnt then holds the number
+    of bytes read.  No other call may be made on this device until
+    the read is complete."""
+    self._async_start(self.co_ibrd_into(buf, num))
+
+  def ibwrta(self, string):
+    """Start writing string in the background, complete it as for ibrda()"""
+    self._async_start(self.co_ibwrt(string))
+
+  def co_ibwrt(self, string):
+    """Coroutine version of ibwrt()"""
+    yield self._co_scmd(0x23, "3s I", "\x05\x05\x08", len(string))
+    if self.stats is not None:
+      t = time.time()
+    yield self._co_send(string)
+    yield self._co_sresp()
+    if self.stats is not None:
+      self._record_data("ibwrt data", len(string), t)
+    raise Return(self.sta)
+
+  def co_ibrd(self, num):
+    """Coroutine version of ibrd()"""
+    yield self._co_scmd(0x16, "3s I", "\x00\x00\x00", num)
+    if self.stats is not None:
+      t = time.time()
+    ret = yield self._co_read(many=True)
+    yield self._co_sresp()
+    if self.stats is not None:
+      self._record_data("ibrd data", len(ret), t)
+    raise Return(ret)
+
+  def co_ibrd_into(self, buf, num=None):
+    """Coroutine version of ibrd_into()"""
+    if num is None:
+      num = len(buf)
+    yield self._co_scmd(0x16, "3s I", "\x00\x00\x00", num)
+    if self.stats is not None:
+      t = time.time()
+    ret = yield self._co_read_into(buf, many=True)
+    yield self._co_sresp()
+    self.cnt = ret
+    if self.stats is not None:
+      self._record_data("ibrd data", ret, t)
+    raise Return(ret)
 
   ibbna = _not_impl("ibbna")
   ibcmd = _not_impl("ibcmd")
   ibcmda = _not_impl("ibcmda")
-  ibwrta = _not_impl("ibwrta")
   ibdiag = _not_impl("ibdiag")
   ibdma = _not_impl("ibdma")
   ibevent = _not_impl("ibevent")
@@ -238,7 +584,6 @@ class EnetSocket(object):
   ibpct = _not_impl("ibpct")
   ibpoke = _not_impl("ibpoke")
   ibppc = _not_impl("ibppc")
-  ibrda = _not_impl("ibrda")
   ibrdf = _not_impl("ibrdf")
   ibrdkey = _not_impl("ibrdkey")
   ibrpp = _not_impl("ibrpp")
@@ -247,18 +592,100 @@ class EnetSocket(object):
   ibsgnl = _not_impl("ibsgnl")
   ibsre = _not_impl("ibsre")
   ibsrq = _not_impl("ibsrq")
-  ibstop = _not_impl("ibstop")
-  ibwrta = _not_impl("ibwrta")
   ibwrtf = _not_impl("ibwrtf")
   ibwrtkey = _not_impl("ibwrtkey")
   ibxtrc = _not_impl("ibxtrc")
  
 
+class EnetReader(object):
+  """File-like view of an ibrd reply while it is still being received.
+
+  readinto() fills a caller supplied buffer (a bytearray or the uint8
+  view of a numpy array) straight from the socket, across fragment
+  boundaries, so a reply can be parsed and decoded piece by piece
+  without ever holding it twice.  Iterating yields the fragments.
+  Once done, sta is the final status of the read."""
+  def __init__(self, sock):
+    self._sock = sock
+    self._left = 0
+    self._t = time.time()
+    self.done = False
+    self.count = 0
+    self.sta = 0
+
+  def _next_frag(self):
+    sock = self._sock
+    flags, num = unpack(sock._headfmt, sock._recv(calcsize(sock._headfmt)))
+    if flags:
+      sock._sresp()
+      sock.cnt = self.count
+      self.sta = sock.sta
+      self.done = True
+      if sock.stats is not None:
+        sock._record_data("ibrd data", self.count, self._t)
+    else:
+      self._left = num
+
+  def readinto(self, buf):
+    """Returns the number of bytes read, less than len(buf) only at the
+    end of the reply"""
+    view = memoryview(buf)
+    n = 0
+    while n < len(view):
+      if not self._left:
+        if self.done:
+          break
+        self._next_frag()
+        continue
+      k = min(self._left, len(view) - n)
+      self._sock._recv_into(view[n:n+k])
+      self._left -= k
+      self.count += k
+      n += k
+    return n
+
+  def read(self, num):
+    buf = bytearray(num)
+    return str(buf[:self.readinto(buf)])
+
+  def skip(self, num):
+    """Discard the next num bytes, returns the number discarded"""
+    scratch = bytearray(min(num, 0x10000))
+    n = 0
+    while n < num:
+      k = self.readinto(memoryview(scratch)[:min(len(scratch), num - n)])
+      if not k:
+        break
+      n += k
+    return n
+
+  def __iter__(self):
+    while True:
+      if not self._left:
+        if self.done:
+          break
+        self._next_frag()
+        continue
+      yield self.read(self._left)
+
+  def close(self):
+    """Discard whatever is left of the reply and read the final status"""
+    while not self.done:
+      if not self.skip(0x10000):
+        break
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self.close()
+
 class EnetLib(object):
   def __init__(self, host, port=5000):
     self._host = host
     self._port = port
     self._uds = {0: None}
+    self._stats = False
 
   def _wrap_ud(self, name):
     def wrapped(ud, *a, **ka):
@@ -280,6 +707,7 @@ class EnetLib(object):
   def ibdev(self, *a, **ka):
     ud = max(self._uds.keys()) + 1
     self._uds[ud] = EnetSocket(self._host, self._port)
+    self._uds[ud].enableStats(self._stats)
     self._uds[ud].ibdev(*a, **ka)
     return ud
 
@@ -299,6 +727,18 @@ class EnetLib(object):
 
   ibcnt = ibcntl
 
+  def enableStats(self, on=True):
+    """Turn EnetSocket.enableStats() on or off for all devices, present
+    and future.  getSocket(ud).stats then holds the figures."""
+    self._stats = on
+    for sock in self._uds.values():
+      if sock is not None:
+        sock.enableStats(on)
+
+  def getSocket(self, ud):
+    """The EnetSocket behind ud, e.g. for its co_* coroutines"""
+    return self._uds[ud]
+
   def __getattr__(self, name):
     return self._wrap_ud(name)
 
@@ -55,7 +55,11 @@ See device specific classes for usage examples
 """
 import time
 import sys
+import threading
+import traceback
+import Queue
 import numpy as np
+from ioloop import Return, Sleep
 
 class OscopeError(Exception):
     def __init__(self, value):
@@ -63,42 +67,367 @@ class OscopeError(Exception):
     def __str__(self):
         return repr(self.value)
 
+class OscopeTimeout(OscopeError):
+    '''The instrument did not answer within the deadline'''
+    pass
+
+class ListenerStats(object):
+    '''Call count and run time of a listener.  coalesced counts the
+       updates a threaded listener skipped because a newer one came'''
+    def __init__(self):
+        self.calls = 0
+        self.coalesced = 0
+        self.errors = 0
+        self.total = 0.
+        self.max = 0.
+        self.last = 0.
+    
+    def record(self, elapsed):
+        self.calls += 1
+        self.total += elapsed
+        self.last = elapsed
+        if elapsed > self.max:
+            self.max = elapsed
+    
+    def mean(self):
+        return self.total/self.calls if self.calls else 0.
+    
+    def __str__(self):
+        return ("%d calls, %d coalesced, %d errors, mean %.3g s, max %.3g s" %
+                (self.calls, self.coalesced, self.errors, self.mean(), self.max))
+
+class _ListenerThread(object):
+    '''Runs a listener on its own thread with the newest update only'''
+    def __init__(self, func, stats):
+        self.func = func
+        self.stats = stats
+        self._cond = threading.Condition()
+        self._pending = None
+        self._running = True
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+    
+    def post(self, item):
+        with self._cond:
+            if self._pending is not None:
+                self.stats.coalesced += 1
+            self._pending = item
+            self._cond.notify()
+    
+    def stop(self):
+        '''Stop once the call in progress, if any, has returned'''
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+        if threading.current_thread() is not self._thread:
+            self._thread.join()
+    
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._pending is None and self._running:
+                    self._cond.wait()
+                if not self._running:
+                    return
+                item, self._pending = self._pending, None
+            start = time.time()
+            try:
+                self.func(item)
+            except Exception:
+                self.stats.errors += 1
+                traceback.print_exc()
+            self.stats.record(time.time() - start)
+
 class AbstractModel(object):
     '''Provides listener callback support for a data model class'''
     def __init__(self):
         self.listeners = []
+        self.listener_stats = {}
+        self._listener_threads = {}
 
-    def addListener(self, listenerFunc):
+    def addListener(self, listenerFunc, threaded=False):
+        '''With threaded the listener runs on its own thread, so a slow
+           one doesn't hold up update().  It is passed a snapshot of the
+           model, see _snapshot(), and only ever the newest one'''
         self.listeners.append(listenerFunc)
+        stats = self.listener_stats[listenerFunc] = ListenerStats()
+        if threaded:
+            self._listener_threads[listenerFunc] = _ListenerThread(listenerFunc, stats)
 
     def removeListener(self, listenerFunc):
         self.listeners.remove(listenerFunc)
+        self.listener_stats.pop(listenerFunc, None)
+        thread = self._listener_threads.pop(listenerFunc, None)
+        if thread is not None:
+            thread.stop()
+
+    def getListenerStats(self, listenerFunc):
+        return self.listener_stats[listenerFunc]
+
+    def _snapshot(self):
+        '''What threaded listeners are passed, the model itself by default'''
+        return self
 
     def update(self):
+        snapshot = None
         for eachFunc in self.listeners:
-            eachFunc(self)
+            thread = self._listener_threads.get(eachFunc)
+            if thread is not None:
+                if snapshot is None:
+                    snapshot = self._snapshot()
+                thread.post(snapshot)
+            else:
+                start = time.time()
+                eachFunc(self)
+                self.listener_stats[eachFunc].record(time.time() - start)
                             
+class TimeAxis(object):
+    '''Sample times t0 + i*dt for i in range(n), stored as just (t0, dt, n).
+       Indexing and slicing are O(1), the array is only built when numpy
+       asks for it and is then kept'''
+    __array_priority__ = 10.
+    
+    def __init__(self, t0, dt, n):
+        self.t0 = t0
+        self.dt = dt
+        self.n = n
+        self._array = None
+    
+    def __len__(self):
+        return self.n
+    
+    def __eq__(self, other):
+        return (isinstance(other, TimeAxis) and
+                (self.t0, self.dt, self.n) == (other.t0, other.dt, other.n))
+    
+    def __ne__(self, other):
+        return not self == other
+    
+    def __repr__(self):
+        return "TimeAxis(%r, %r, %r)" % (self.t0, self.dt, self.n)
+    
+    def __array__(self, dtype=None):
+        if self._array is None:
+            self._array = np.arange(self.n)*self.dt + self.t0
+            self._array.flags.writeable = False     # shared by every caller
+        if dtype is not None:
+            return self._array.astype(dtype)
+        return self._array
+    
+    def __iter__(self):
+        for i in xrange(self.n):
+            yield self.t0 + i*self.dt
+    
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self.n)
+            n = max(0, (stop - start + step - (1 if step > 0 else -1))//step)
+            return TimeAxis(self.t0 + start*self.dt, self.dt*step, n)
+        if isinstance(index, (int, long, np.integer)):
+            if index < 0:
+                index += self.n
+            if not 0 <= index < self.n:
+                raise IndexError("time axis index out of range")
+            return self.t0 + index*self.dt
+        return np.asarray(self)[index]
+    
+    def indexOf(self, t):
+        '''Index of the sample nearest to time t, clipped to the axis'''
+        i = int(round((t - self.t0)/self.dt)) if self.dt else 0
+        return min(max(i, 0), self.n - 1)
+    
+    def window(self, t_start, t_stop):
+        '''Slice of the samples from t_start to t_stop, for example
+           data[axis.window(0, 1e-6)]'''
+        return slice(self.indexOf(t_start), self.indexOf(t_stop) + 1)
+    
+    # Arithmetic with scalars gives another TimeAxis, e.g. axis*1e6 for
+    # microseconds, anything else works on the array
+    def __add__(self, other):
+        if np.isscalar(other):
+            return TimeAxis(self.t0 + other, self.dt, self.n)
+        return np.asarray(self) + other
+    __radd__ = __add__
+    
+    def __sub__(self, other):
+        if np.isscalar(other):
+            return TimeAxis(self.t0 - other, self.dt, self.n)
+        return np.asarray(self) - other
+    
+    def __rsub__(self, other):
+        return -self + other
+    
+    def __mul__(self, other):
+        if np.isscalar(other):
+            return TimeAxis(self.t0*other, self.dt*other, self.n)
+        return np.asarray(self)*other
+    __rmul__ = __mul__
+    
+    def __div__(self, other):
+        if np.isscalar(other):
+            return TimeAxis(self.t0/other, self.dt/other, self.n)
+        return np.asarray(self)/other
+    __truediv__ = __div__
+    
+    def __rdiv__(self, other):
+        return other/np.asarray(self)
+    __rtruediv__ = __rdiv__
+    
+    def __neg__(self):
+        return TimeAxis(-self.t0, -self.dt, self.n)
+    
+def nativeOrder(data):
+    '''data in native byte order, swapped in place when it is writable'''
+    if data.dtype.isnative:
+        return data
+    native = data.dtype.newbyteorder('=')
+    if not data.flags.writeable:
+        return data.astype(native)
+    data.byteswap(True)
+    return data.view(native)
+
 class ScopeChannel(object):
     '''Data and state container for a scope channel
-       scope is a scope object instance'''
+       scope is a scope object instance.  data holds the raw samples at
+       the instrument's own width, scaling is applied on request'''
+    __slots__ = ('scope', 'channel_num', 'history', 'data', 'volt_gain',
+                 'volt_offset', '_scaled')
+    
     def __init__(self, scope, channel_num):
         self.scope = scope
         self.channel_num = channel_num
+        self.history = None     # ScopeHistory, see Scope.enableHistory()
+        self.data = None
+        self.volt_gain = 0.
+        self.volt_offset = 0.
+        self._scaled = {}
     
     def grabChannelData(self):
         '''Grab new data from the scope'''
         data, vert_gain, vert_offset = self.scope._readWaveform(self.channel_num)
-        self.data = data
+        self.setChannelData(data, vert_gain, vert_offset)
+    
+    def setChannelData(self, data, vert_gain, vert_offset):
+        '''Store a waveform read by other means than grabChannelData'''
+        self.data = nativeOrder(data)
+        self.volt_gain = vert_gain
+        self.volt_offset = vert_offset
+        self._scaled = {}   # dtype: scaled trace, computed on demand
+    
+    def getScaledWaveform(self, dtype=np.float64, out=None, cached=False):
+        """Returns a numpy array with voltage scaled scope trace from most recent grab
+           With out the trace is scaled into that array instead.  With
+           cached it is computed once per grab and dtype and shared, so
+           it is read only"""
+        if out is None and not cached:
+            out = np.empty(len(self.data), dtype=dtype)
+        if out is not None:
+            np.multiply(self.data, self.volt_gain, out)
+            out -= self.volt_offset
+            return out
+        dtype = np.dtype(dtype)
+        scaled = self._scaled.get(dtype)
+        if scaled is None:
+            scaled = np.empty(len(self.data), dtype=dtype)
+            np.multiply(self.data, self.volt_gain, scaled)
+            scaled -= self.volt_offset
+            scaled.flags.writeable = False
+            self._scaled[dtype] = scaled
+        return scaled
+        
+    def getData(self):
+        return self.data
+    
+class ScopeHistory(object):
+    '''Fixed capacity ring buffer of the last shots of a channel.
+       Each shot is written twice, at row i and i + capacity, so that the
+       last n shots are always contiguous rows and can be handed out as
+       views, oldest first, without copying'''
+    META_DTYPE = np.dtype([('gain', 'f8'), ('offset', 'f8'), ('dt', 'f8'),
+                           ('t0', 'f8'), ('timestamp', 'f8')])
+    
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.data = None
+        self.meta = np.zeros(2*capacity, dtype=self.META_DTYPE)
+        self.count = 0      # shots appended since the last clear()
+    
+    def __len__(self):
+        return min(self.count, self.capacity)
+    
+    def clear(self):
+        self.count = 0
+    
+    def append(self, data, vert_gain, vert_offset, dt, t0, timestamp):
+        '''Store a copy of data, the buffer is allocated on the first
+           shot and again whenever the record length or type changes'''
+        if (self.data is None or self.data.shape[1] != len(data) or
+            self.data.dtype != data.dtype):
+            self.data = np.empty((2*self.capacity, len(data)), dtype=data.dtype)
+            self.count = 0
+        i = self.count % self.capacity
+        meta = (vert_gain, vert_offset, dt, t0, timestamp)
+        for row in (i, i + self.capacity):
+            self.data[row] = data
+            self.meta[row] = meta
+        self.count += 1
+    
+    def _rows(self, n):
+        if n is None or n > len(self):
+            n = len(self)
+        end = (self.count - 1) % self.capacity + self.capacity + 1
+        return slice(end - n, end)
+    
+    def getData(self, n=None):
+        '''(n, points) view of the raw samples of the last n shots'''
+        if not self.count:
+            return None
+        return self.data[self._rows(n)]
+    
+    def getMeta(self, n=None):
+        '''View of gain, offset, dt, t0 and timestamp of the last n shots'''
+        return self.meta[self._rows(n)] if self.count else self.meta[:0]
+    
+    def getScaledWaveform(self, n=None):
+        """Returns a (n, points) array of the voltage scaled last n shots"""
+        if not self.count:
+            return None
+        rows = self._rows(n)
+        meta = self.meta[rows]
+        return self.data[rows]*meta['gain'][:, None] - meta['offset'][:, None]
+    
+class ScopeSegments(object):
+    '''Data container for a sequence (segmented) acquisition of a channel
+       data is a (segments, points) array of raw samples, trigger_times
+       holds the trigger time of each segment relative to the first one
+       and trigger_offsets the time from each trigger to the segment's
+       first sample'''
+    def __init__(self, channel_num, data, vert_gain, vert_offset, dt,
+                 trigger_times, trigger_offsets, timestamp):
+        self.channel_num = channel_num
+        self.data = nativeOrder(data)
         self.volt_gain = vert_gain
         self.volt_offset = vert_offset
+        self.dt = dt
+        self.trigger_times = trigger_times
+        self.trigger_offsets = trigger_offsets
+        self.timestamp = timestamp
+    
+    def __len__(self):
+        return self.data.shape[0]
     
     def getScaledWaveform(self):
-        """Returns a numpy array with voltage scaled scope trace from most recent grab"""
+        """Returns a (segments, points) array of voltage scaled traces"""
         return self.data*self.volt_gain - self.volt_offset
-        
+    
     def getData(self):
         return self.data
     
+    def getTimeAxis(self, segment=0):
+        '''Time of each sample of segment relative to its trigger'''
+        return TimeAxis(self.trigger_offsets[segment], self.dt, self.data.shape[1])
+    
 
 class Scope(AbstractModel):
     '''Abstract Oscilloscope Base Class
@@ -118,7 +447,8 @@ class Scope(AbstractModel):
         self.timestamp = -1.
         self.dt = 0
         self.t0 = 0
-        self.time_axis = None
+        self.timeaxis = None
+        self.sequences = {}
         
     
     ################
@@ -126,7 +456,10 @@ class Scope(AbstractModel):
     # Override Required
     ################
     def _makeTimeAxis(self):
-        self.timeaxis = np.arange(self.size)*self.dt + self.t0
+        '''Keeps the current TimeAxis, and its array, while unchanged'''
+        axis = TimeAxis(self.t0, self.dt, self.size)
+        if axis != self.timeaxis:
+            self.timeaxis = axis
     
     def _writeWaveform(self, fo, header='', binary=False):
         """Write the most recently acquired data to file"""
@@ -163,6 +496,16 @@ class Scope(AbstractModel):
     ################
     def stop(self): pass
     def run(self): pass
+    def waitForTrigger(self, timeout=None):
+        '''Wait until a new acquisition is ready to grab, False if none
+           came within timeout seconds.  Scopes which can't tell say yes'''
+        return True
+    def grabSequence(self, timeout=60.):
+        '''Arm once and read all segments of a sequence acquisition,
+           waiting up to timeout seconds.  Returns {chan: ScopeSegments}.
+           The segments are not published: listeners are not notified
+           and channel history is not appended, unlike grabData()'''
+        raise OscopeError("%s does not support sequence mode" % self.name.strip())
     def unlock(self): pass
     def close(self): pass
     
@@ -193,11 +536,90 @@ class Scope(AbstractModel):
             if mask & self.active_channels:
                 self.channels[i].grabChannelData()
                 self.grabbed_channels |= mask
+        self._publish()
+    
+    def grabDataAsync(self):
+        '''Coroutine version of grabData() for an ioloop.IOLoop.  Drivers
+           override it, here it just blocks in grabData()'''
+        self.grabData()
+        return
+        yield
+    
+    def stream(self, count=None, channels=None, rate=None, reuse=False):
+        '''Generator of a ScopeFrame for each of count acquisitions, or
+           without end for None.  channels lists the channels to grab,
+           by default the active ones, and rate limits the frames per
+           second.  With reuse the arrays of each frame are recycled for
+           the next one, so a frame is only valid until the next is
+           asked for, and no memory is allocated per frame'''
+        active, self.active_channels = self.active_channels, self._channelMask(channels)
+        try:
+            frame = None
+            n = 0
+            next_start = time.time()
+            while count is None or n < count:
+                wait = next_start - time.time()
+                if wait > 0:
+                    time.sleep(wait)
+                next_start = time.time() + (1./rate if rate else 0.)
+                self.grabData()
+                frame = ScopeFrame(self, frame if reuse else None)
+                yield frame
+                n += 1
+        finally:
+            self.active_channels = active
+    
+    def streamAsync(self, callback, count=None, channels=None, rate=None, reuse=False):
+        '''Coroutine version of stream() for an ioloop.IOLoop, grabs with
+           grabDataAsync() and calls callback(frame) with each frame.
+           Returns the number of frames'''
+        active, self.active_channels = self.active_channels, self._channelMask(channels)
+        try:
+            frame = None
+            n = 0
+            next_start = time.time()
+            while count is None or n < count:
+                wait = next_start - time.time()
+                if wait > 0:
+                    yield Sleep(wait)
+                next_start = time.time() + (1./rate if rate else 0.)
+                yield self.grabDataAsync()
+                frame = ScopeFrame(self, frame if reuse else None)
+                callback(frame)
+                n += 1
+        finally:
+            self.active_channels = active
+        raise Return(n)
+    
+    def _channelMask(self, channels):
+        if channels is None:
+            return self.active_channels
+        mask = 0
+        for chan in channels:
+            if not chan - 1 in range(self.n_chans): raise OscopeError("Invalid channed %d"%chan)
+            mask |= 1 << (chan - 1)
+        return mask
+    
+    def _publish(self):
+        '''Stamp the channels just grabbed and notify listeners'''
         if self.grabbed_channels:
             self.timestamp = time.time()
             self._makeTimeAxis()
+            for i, channel in enumerate(self.channels):
+                if channel.history is not None and (1 << i) & self.active_channels:
+                    channel.history.append(channel.data, channel.volt_gain,
+                                           channel.volt_offset, self.dt,
+                                           self.t0, self.timestamp)
             self.update()  # Notify listeners
     
+    def getFrame(self):
+        '''Immutable ScopeFrame of the last acquisition'''
+        return ScopeFrame(self)
+    
+    def _snapshot(self):
+        # threaded listeners get a frame, the scope moves on meanwhile
+        return self.getFrame()
+    
     def writeWaveformToFile(self, filename, header='', binary=False):
         """Write the most recently acquired data to file"""
         if filename == "": fo = sys.stdout # use stdout if no filename
@@ -205,11 +627,11 @@ class Scope(AbstractModel):
         self._writeWaveform(fo, header, binary)
         fo.close()
        
-    def getScaledWaveform(self,chan):
-        '''Channel numbers start at 1 not zero'''
+    def getScaledWaveform(self, chan, dtype=np.float64, out=None, cached=False):
+        '''Channel numbers start at 1 not zero, see ScopeChannel.getScaledWaveform'''
         chan = chan - 1
         if not chan in range(self.n_chans): raise OscopeError("Invalid channed %d"%chan)
-        return self.channels[chan].getScaledWaveform()
+        return self.channels[chan].getScaledWaveform(dtype, out, cached)
         
     def getRawWaveform(self, chan):
         chan = chan - 1
@@ -221,29 +643,411 @@ class Scope(AbstractModel):
         if not chan in range(self.n_chans): raise OscopeError("Invalid channed %d"%chan)
         return self.channels[chan].volt_gain
         
+    def enableHistory(self, capacity=100):
+        '''Keep the last capacity shots of every channel, 0 to stop'''
+        for channel in self.channels:
+            if capacity:
+                channel.history = ScopeHistory(capacity)
+            else:
+                channel.history = None
+    
+    def getHistory(self, chan):
+        '''ScopeHistory of chan, see enableHistory()'''
+        chan = chan - 1
+        if not chan in range(self.n_chans): raise OscopeError("Invalid channed %d"%chan)
+        if self.channels[chan].history is None: raise OscopeError("History is not enabled")
+        return self.channels[chan].history
+        
+    def getSequence(self, chan):
+        '''ScopeSegments of chan from the last grabSequence()'''
+        if not chan in self.sequences: raise OscopeError("No sequence grabbed for channel %d"%chan)
+        return self.sequences[chan]
+        
     def getVertOffset(self, chan):
         chan = chan - 1
         if not chan in range(self.n_chans): raise OscopeError("Invalid channed %d"%chan)
         return self.channels[chan].volt_offset
         
+class ScopeFrame(object):
+    '''Immutable snapshot of one acquisition, see Scope.getFrame().  The
+       samples are copied out of the scope so the frame stays valid
+       however long a consumer keeps it.  Passing an old frame as reuse
+       copies into its arrays instead, which ends that frame's validity'''
+    def __init__(self, scope, reuse=None):
+        channels = {}
+        for i, channel in enumerate(scope.channels):
+            if (1 << i) & scope.active_channels & scope.grabbed_channels:
+                old = reuse.channels.get(i + 1) if reuse is not None else None
+                if (old is not None and old[0].shape == channel.data.shape and
+                    old[0].dtype == channel.data.dtype):
+                    data = old[0]
+                    data.flags.writeable = True
+                    data[...] = channel.data
+                else:
+                    data = np.array(channel.data)
+                data.flags.writeable = False
+                channels[i + 1] = (data, channel.volt_gain, channel.volt_offset)
+        set = object.__setattr__
+        set(self, 'name', scope.name)
+        set(self, 'timestamp', scope.timestamp)
+        set(self, 'dt', scope.dt)
+        set(self, 't0', scope.t0)
+        set(self, 'size', scope.size)
+        set(self, 'channels', channels)
+    
+    def __setattr__(self, name, value):
+        raise AttributeError("ScopeFrame is immutable")
+    
+    def _channel(self, chan):
+        if not chan in self.channels: raise OscopeError("Channel %d not in frame"%chan)
+        return self.channels[chan]
+    
+    def getTimeAxis(self):
+        return TimeAxis(self.t0, self.dt, self.size)
+    
+    def getRawWaveform(self, chan):
+        return self._channel(chan)[0]
+    
+    def getScaledWaveform(self, chan, dtype=np.float64):
+        data, vert_gain, vert_offset = self._channel(chan)
+        scaled = np.multiply(data, vert_gain, dtype=dtype)
+        scaled -= vert_offset
+        return scaled
+    
+    def getVertGain(self, chan):
+        return self._channel(chan)[1]
+    
+    def getVertOffset(self, chan):
+        return self._channel(chan)[2]
+    
+class ChannelAccumulator(object):
+    '''Running mean, variance (Welford) and min/max envelope of the raw
+       samples of one channel, updated in place in float64 arrays'''
+    def __init__(self, size):
+        self.count = 0
+        self.mean = np.zeros(size)
+        self.m2 = np.zeros(size)
+        self.min = np.zeros(size)
+        self.max = np.zeros(size)
+        self._delta = np.empty(size)
+        self._tmp = np.empty(size)
+        self.setup = None   # (gain, offset, dt, dtype) of the shots
+    
+    def reset(self):
+        self.count = 0
+    
+    def add(self, data):
+        self.count += 1
+        if self.count == 1:
+            self.mean[:] = data
+            self.m2.fill(0.)
+            self.min[:] = data
+            self.max[:] = data
+            return
+        delta, tmp = self._delta, self._tmp
+        np.subtract(data, self.mean, delta)
+        np.multiply(delta, 1./self.count, tmp)
+        self.mean += tmp
+        np.subtract(data, self.mean, tmp)
+        tmp *= delta
+        self.m2 += tmp
+        np.minimum(self.min, data, self.min)
+        np.maximum(self.max, data, self.max)
+    
+    def getVariance(self):
+        '''Sample variance of the raw samples'''
+        if self.count < 2:
+            return np.zeros_like(self.m2)
+        return self.m2/(self.count - 1)
+    
+class ScopeAccumulator(object):
+    '''Host side averaging and envelope of any Scope, over as many shots
+       as wanted.  Added as a listener it accumulates every grab of the
+       scope, or shots can be added by hand with add(scope) or
+       add(frame).  The raw samples are accumulated, so with
+       reset_on_change a change of size, gain, offset or dt starts over,
+       without it such shots are mixed in unchecked'''
+    def __init__(self, scope=None, channels=None, reset_on_change=True):
+        self.channels = channels
+        self.reset_on_change = reset_on_change
+        self.accumulators = {}  # chan: ChannelAccumulator
+        self.resets = 0         # times a setup change started over
+        self.scope = scope
+        if scope is not None:
+            scope.addListener(self.add)
+    
+    def detach(self):
+        '''Stop accumulating the grabs of the scope'''
+        if self.scope is not None:
+            self.scope.removeListener(self.add)
+            self.scope = None
+    
+    def reset(self):
+        for acc in self.accumulators.values():
+            acc.reset()
+    
+    def _shots(self, source):
+        '''(chan, data, gain, offset) of a Scope or ScopeFrame'''
+        if isinstance(source, ScopeFrame):
+            for chan, (data, gain, offset) in source.channels.items():
+                yield chan, data, gain, offset
+        else:
+            for i, channel in enumerate(source.channels):
+                if (1 << i) & source.active_channels & source.grabbed_channels:
+                    yield i + 1, channel.data, channel.volt_gain, channel.volt_offset
+    
+    def add(self, source):
+        '''Accumulate the last shot of a Scope, or a ScopeFrame'''
+        for chan, data, gain, offset in self._shots(source):
+            if self.channels is not None and chan not in self.channels:
+                continue
+            setup = (len(data), gain, offset, source.dt, data.dtype)
+            acc = self.accumulators.get(chan)
+            if acc is None or len(acc.mean) != len(data):
+                acc = self.accumulators[chan] = ChannelAccumulator(len(data))
+            elif acc.count and setup != acc.setup and self.reset_on_change:
+                acc.reset()
+                self.resets += 1
+            acc.setup = setup
+            acc.add(data)
+    
+    def _get(self, chan):
+        if not chan in self.accumulators or not self.accumulators[chan].count:
+            raise OscopeError("Nothing accumulated for channel %d"%chan)
+        return self.accumulators[chan]
+    
+    def getCount(self, chan):
+        acc = self.accumulators.get(chan)
+        return acc.count if acc is not None else 0
+    
+    def getMean(self, chan):
+        '''Voltage scaled mean of the accumulated shots'''
+        acc = self._get(chan)
+        gain, offset = acc.setup[1:3]
+        return acc.mean*gain - offset
+    
+    def getVariance(self, chan):
+        '''Variance of the accumulated shots in V**2'''
+        acc = self._get(chan)
+        return acc.getVariance()*acc.setup[1]**2
+    
+    def getStd(self, chan):
+        return np.sqrt(self.getVariance(chan))
+    
+    def getMin(self, chan):
+        '''Voltage scaled lower envelope'''
+        acc = self._get(chan)
+        gain, offset = acc.setup[1:3]
+        return (acc.min if gain >= 0 else acc.max)*gain - offset
+    
+    def getMax(self, chan):
+        '''Voltage scaled upper envelope'''
+        acc = self._get(chan)
+        gain, offset = acc.setup[1:3]
+        return (acc.max if gain >= 0 else acc.min)*gain - offset
+    
+class AcquisitionWorker(object):
+    '''Runs scope.grabData() continuously on a background thread and
+       queues a ScopeFrame of every acquisition, so consumers read at
+       their own pace.  When the queue of maxsize frames is full the
+       policy DROP_OLDEST discards the oldest frame, BLOCK waits for
+       the consumers.  interval is the least time between grabs, with
+       wait_trigger each grab waits for Scope.waitForTrigger()'''
+    DROP_OLDEST = 'drop oldest'
+    BLOCK = 'block'
+    
+    def __init__(self, scope, maxsize=4, policy=DROP_OLDEST, interval=0.,
+                 wait_trigger=False):
+        if policy not in (self.DROP_OLDEST, self.BLOCK):
+            raise OscopeError("Unknown queue policy %r" % policy)
+        self.scope = scope
+        self.policy = policy
+        self.interval = interval
+        self.wait_trigger = wait_trigger
+        self.trigger_timeout = 1.   # to check for stop() meanwhile
+        self.frames = Queue.Queue(maxsize)
+        self.dropped = 0    # frames discarded by DROP_OLDEST
+        self.count = 0      # frames acquired
+        self.error = None   # exc_info of the grab that stopped the worker
+        self._running = threading.Event()
+        self._thread = None
+    
+    def start(self):
+        if self.isRunning():
+            return
+        self.error = None
+        self._running.set()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+    
+    def stop(self, timeout=None):
+        '''Stop after the grab in progress, which may take timeout seconds'''
+        self._running.clear()
+        if self._thread is not None:
+            self._thread.join(timeout)
+    
+    def isRunning(self):
+        return self._thread is not None and self._thread.is_alive()
+    
+    def _run(self):
+        while self._running.is_set():
+            start = time.time()
+            try:
+                if self.wait_trigger and not self.scope.waitForTrigger(self.trigger_timeout):
+                    continue
+                self.scope.grabData()
+            except Exception:
+                self.error = sys.exc_info()
+                break
+            self._put(self.scope.getFrame())
+            self.count += 1
+            wait = start + self.interval - time.time()
+            if wait > 0:
+                time.sleep(wait)
+        self._running.clear()
+    
+    def _put(self, frame):
+        while self._running.is_set():
+            try:
+                if self.policy == self.BLOCK:
+                    self.frames.put(frame, timeout=0.1)
+                else:
+                    self.frames.put_nowait(frame)
+                return
+            except Queue.Full:
+                if self.policy == self.DROP_OLDEST:
+                    try:
+                        self.frames.get_nowait()
+                        self.dropped += 1
+                    except Queue.Empty:
+                        pass
+    
+    def get(self, timeout=None):
+        '''Next frame, None if there is none within timeout seconds or
+           the worker has stopped.  Raises the error which stopped the
+           worker once it is drained'''
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            # wait in slices, the worker may stop while we wait
+            wait = 0.1
+            if deadline is not None:
+                wait = max(min(deadline - time.time(), wait), 0.)
+            running = self.isRunning()
+            try:
+                return self.frames.get(timeout=wait)
+            except Queue.Empty:
+                pass
+            if not running or (deadline is not None and time.time() >= deadline):
+                self._raiseError()
+                return None
+    
+    def getLatest(self):
+        '''Newest queued frame, discarding older ones, or None'''
+        frame = None
+        while True:
+            try:
+                frame = self.frames.get_nowait()
+            except Queue.Empty:
+                break
+        if frame is None:
+            self._raiseError()
+        return frame
+    
+    def _raiseError(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error[0], error[1], error[2]
+    
+class ScopeGroup(AbstractModel):
+    '''Several scopes on a common trigger, acquired in parallel.  Each
+       scope has its own worker thread as each sits on its own bus, the
+       listeners of the group are notified once all of them are done'''
+    def __init__(self, scopes=()):
+        AbstractModel.__init__(self)
+        self.scopes = []
+        self._jobs = []
+        self._done = Queue.Queue()
+        self.timestamp = -1.
+        self.timing = []    # (start, end) of the last grab of each scope
+        for scope in scopes:
+            self.addScope(scope)
+    
+    def __len__(self):
+        return len(self.scopes)
+    
+    def __getitem__(self, i):
+        return self.scopes[i]
+    
+    def addScope(self, scope):
+        jobs = Queue.Queue()
+        worker = threading.Thread(target=self._work, args=(len(self.scopes), scope, jobs))
+        worker.daemon = True
+        worker.start()
+        self.scopes.append(scope)
+        self._jobs.append(jobs)
+        self.timing.append((-1., -1.))
+    
+    def _work(self, i, scope, jobs):
+        while jobs.get():
+            start = time.time()
+            try:
+                scope.grabData()
+                error = None
+            except Exception:
+                error = sys.exc_info()
+            self._done.put((i, start, time.time(), error))
+    
+    def grabData(self):
+        '''Acquire from all scopes at once, then notify listeners.  If a
+           scope fails the error is raised once the others have finished'''
+        self.timestamp = time.time()
+        for jobs in self._jobs:
+            jobs.put(True)
+        errors = []
+        for k in range(len(self.scopes)):
+            i, start, end, error = self._done.get()
+            self.timing[i] = (start, end)
+            if error is not None:
+                errors.append(error)
+        if errors:
+            raise errors[0][0], errors[0][1], errors[0][2]
+        self.update()  # Notify listeners
+    
+    def getSkew(self):
+        '''Spread of the start times of the last grab in seconds'''
+        starts = [start for start, end in self.timing]
+        return max(starts) - min(starts)
+    
+    def getElapsed(self):
+        '''Time taken by each scope in the last grab'''
+        return [end - start for start, end in self.timing]
+    
+    def close(self):
+        '''Stop the workers and close all scopes'''
+        for jobs, scope in zip(self._jobs, self.scopes):
+            jobs.put(False)
+            scope.close()
+        self._jobs = []
+        self.scopes = []
+        self.timing = []
+    
 class DummyScope(Scope):
     def __init__(self, size=600, dt=10e-9):
         Scope.__init__(self, n_chans=2)
         self.size = size
         self.dt =  dt
         self.t0 = 0.     
-    def _makeTimeAxis(self):
-        self.timeaxis = np.arange(self.size)*self.dt + self.t0
     def _writeWaveform(self, outfile, header, binary): 
         print "Dummy: writeWaveformToFile"
     def _readWaveform(self, chan):
         N = self.size
-        data = np.zeros(N)
+        data = np.zeros(N, dtype='i1')
         if chan==1:
-            data[N/4:N - N/4] = 0.1
+            data[N/4:N - N/4] = 100
         if chan==2:
-            data[250:350] = -0.03
-        vert_gain = 2.0
+            data[250:350] = -30
+        vert_gain = 2e-3
         vert_offset = 0.0
         return data, vert_gain, vert_offset
     def _idn(self):
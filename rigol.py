@@ -16,52 +16,80 @@
 #
 # V2 - inherit from Scope
 #===========================================================
-import os
+import errno
 import sys
 import numpy as np
 import time
-from oscope import Scope,OscopeError
+from oscope import Scope,OscopeError,OscopeTimeout
+from usbtmc import UsbtmcDevice
+from ioloop import Return
 
-RIGOL_WAV_PREAMBLE_LENGTH = 10
+RIGOL_WAV_PREAMBLE_LENGTH = 10  # "#8nnnnnnnn"
 RIGOL_N_DIVS = 12
-RAW_DATA_LENGTH = 9000
+RIGOL_TIMEBASE_QUERIES = (":TIM:SCAL?", ":TIM:OFFS?")
+RIGOL_SAMPLE_RATE_QUERY = ":ACQ:SAMP? CHAN%d"
+RIGOL_BLOCK_CHUNK = 1 << 16    # bytes per read of a deep memory record
 
 class RigolScope(Scope):
-    '''Class to control a Rigol DS1000 series oscilloscope''
-    def __init__(self, device):
-        '''Initialize Hardware'''
-        try:
-            # Get a handle to the IO device
-            self.FILE = os.open(device, os.O_RDWR)
-        except OSError as e:
-            raise OscopeError("Error opening device: " + str(e))
+    '''Class to control a Rigol DS1000 series oscilloscope'''
+    def __init__(self, device, timeout=5.):
+        '''Initialize Hardware.  timeout is the default deadline in
+           seconds for each read or write.  device is the usbtmc path or
+           an open stand-in with UsbtmcDevice's read/write/close'''
+        if isinstance(device, basestring):
+            try:
+                # Get a handle to the IO device
+                self.dev = UsbtmcDevice(device, timeout)
+            except OSError as e:
+                raise OscopeError("Error opening device: " + str(e))
+        else:
+            self.dev = device
+        self.FILE = getattr(self.dev, 'fd', None)
+        self.device = device
+        # Cached settings {query: (value, time)}.  Any command that is not
+        # a query drops them, the front panel is locked while in remote.
+        self._settings = {}
+        self.settings_max_age = None    # seconds, None to keep until dropped
+        self.batch_queries = False      # send cache misses as one ";" query
+        # Deep memory: read the whole acquisition memory of a stopped scope
+        # instead of the 600 screen points, see setDeepMemory()
+        self.deep_memory = False
+        self.progress = None    # progress(chan, received, total) during reads
+        self.trigger_poll = 0.01    # seconds between :TRIG:STAT? polls
+        self._armed = False     # :RUN sent since the last acquisition
+        self._acquiring = False # WAIT/RUN/AUTO seen since then
+        self._bufpool = {}
         Scope.__init__(self, n_chans=2)
         
     ##############################
     #  Required Overrides        #
     ##############################
-    def _write(self,message):
+    def _write(self, message, timeout=None):
         """Write command directly to the device"""
+        if '?' not in message:
+            self.invalidateSettings()  # may change settings or unlock the panel
         try:
-            os.write(self.FILE, message);
+            self.dev.write(message, timeout)
         except OSError as e:
-            print >> sys.stderr, "Write Error: ", e
+            self._ioError("Write", e)
 
-    def _read(self,numbytes=300):
-        """Read an arbitrary amount of data directly from the device"""
+    def _read(self, numbytes=300, timeout=None):
+        """Read an arbitrary amount of data directly from the device.
+           Raises OscopeTimeout if nothing arrives within timeout seconds"""
         try:
-            return os.read(self.FILE, numbytes)
+            return self.dev.read(numbytes, timeout)
         except OSError as e:
-            if e.args[0] == 110:
-                print >> sys.stderr, "Read Error: Read timeout"
-            else:
-                print >> sys.stderr, "Read Error: ", e
-            return ""
+            self._ioError("Read", e)
         
-    def _query(self,message,numbytes=300):
+    def _query(self, message, numbytes=300, timeout=None):
         '''Returns just the response'''
-        self._write(message)
-        return self._read(numbytes)
+        self._write(message, timeout)
+        return self._read(numbytes, timeout)
+
+    def _ioError(self, op, e):
+        if e.errno == errno.ETIMEDOUT:
+            raise OscopeTimeout("%s timeout on %s" % (op, self.device))
+        raise OscopeError("%s error on %s: %s" % (op, self.device, e))
 
     def _idn(self):
         return self._query("*IDN?")
@@ -73,44 +101,45 @@ class RigolScope(Scope):
         #FIXME
         '''Read full waveform and header from the scope to produced a scaled waveform
            horizontal is set again for every channel since we don't know which channels will get used'''
-        buf = self._readRawWaveform(chan)
-        # Get data and invert
-        data = 255 - np.frombuffer(buf, dtype='B', offset=RIGOL_WAV_PREAMBLE_LENGTH)
-        
+        return self._scaleWaveform(chan, self._readRawWaveform(chan))
+
+    def _scaleWaveform(self, chan, data):
+        '''Scaling of the raw samples of chan, sets dt, t0 and size.
+           data stays the uint8 pooled buffer, valid until the next read of
+           chan.  The scope sends it inverted, 255 - v, which is folded
+           into a negative gain'''
         # fix the scaling of these parameters
-        v_scale = self._getVoltScale(chan)
-        v_offset = self._getVoltOffset(chan)
+        v_scale, v_offset = self._getSettings((":CHAN%d:SCAL?"%chan, ":CHAN%d:OFFS?"%chan))
+        h_scale, horiz_offset = self._getSettings(RIGOL_TIMEBASE_QUERIES)
         
-        h_scale = self._getTimeScale()
-        horiz_offset = self._getTimeOffset()
-        
-        vert_gain = v_scale/25. # V/pt,   from 25 pts/div for 200 total over 8 divs
-        vert_offset = v_offset + 130.*vert_gain  # screen center is at v_off
+        v_per_pt = v_scale/25. # V/pt,   from 25 pts/div for 200 total over 8 divs
+        # (255 - raw)*v_per_pt - (v_off + 130*v_per_pt), screen center is at v_off
+        vert_gain = -v_per_pt
+        vert_offset = v_offset - 125.*v_per_pt
 
         n_data = len(data)
-        horiz_span = RIGOL_N_DIVS*h_scale*1.0
-        horiz_interval = horiz_span/n_data
+        if self.deep_memory:
+            # the record is sampled at the acquisition rate and centered
+            # on the screen center like the 600 screen points
+            horiz_interval = 1./self._getSettings((RIGOL_SAMPLE_RATE_QUERY % chan,))[0]
+            horiz_span = n_data*horiz_interval
+        else:
+            horiz_span = RIGOL_N_DIVS*h_scale*1.0
+            horiz_interval = horiz_span/n_data
         self.dt = horiz_interval                # sample interval
         self.t0 = horiz_offset - (horiz_span/2) # time offset of bin zero
         self.size = n_data
 
         return (data, vert_gain, vert_offset) 
 
-    def _makeTimeAxis(self):
-        """Retrieve timescale and offset from the scope and return an array or
-           time points corresponding to the present scope trace
-           Units are seconds by default
-           Returns a numpy array of time points"""
-        self.timeaxis = np.arange(self.size)*self.dt + self.t0
-
     def _writeWaveform(self, fo, header='', binary=False):
         # FIXME
         data1 = np.zeros(self.size)
         data2 = np.zeros(self.size)
         if self.grabbed_channels | 1:
-            data1 = self.channels[0].getScaledWaveform()
+            data1 = self.channels[0].getScaledWaveform(cached=True)
         if self.grabbed_channels | 2:
-            data2 = self.channels[1].getScaledWaveform()
+            data2 = self.channels[1].getScaledWaveform(cached=True)
 
         fo.write(header)
         fo.write("# DeviceId=" + self.name.strip() + '\n')
@@ -130,24 +159,191 @@ class RigolScope(Scope):
         """Read raw data from scope channel"""
         command = ":WAV:DATA? CHAN" + str(chan)
         self._write(command)
-        return self._read(RAW_DATA_LENGTH)
+        return self._readBlock(chan)
+    
+    def _readBlock(self, chan):
+        """Read an IEEE 488.2 "#8nnnnnnnn" block in two phases: the header
+           first, then the announced number of bytes in RIGOL_BLOCK_CHUNK
+           pieces into the pooled buffer of chan"""
+        length = self._blockLength(self._read(RIGOL_WAV_PREAMBLE_LENGTH))
+        buf = self._getBuffer(chan, length)
+        n = 0
+        while n < length:
+            chunk = self._read(min(length - n, RIGOL_BLOCK_CHUNK))
+            n = self._storeChunk(chan, buf, n, chunk)
+        return buf
+    
+    def _blockLength(self, head):
+        if head[:1] != '#' or not head[1:].isdigit():
+            raise OscopeError("Bad waveform block header %r" % head)
+        return int(head[2:])
+    
+    def _storeChunk(self, chan, buf, n, chunk):
+        '''Copy chunk to buf[n:] and report progress, returns the new fill'''
+        length = len(buf)
+        if not chunk:
+            raise OscopeError("Waveform block ended after %d of %d bytes" % (n, length))
+        buf[n:n+len(chunk)] = np.frombuffer(chunk, dtype='B')
+        n += len(chunk)
+        if self.progress:
+            self.progress(chan, n, length)
+        return n
+    
+    def _getBuffer(self, chan, size):
+        '''Sample buffer for chan from the pool, reused while the size is unchanged'''
+        buf = self._bufpool.get(chan)
+        if buf is None or len(buf) != size:
+            buf = self._bufpool[chan] = np.empty(size, dtype='B')
+        return buf
+    
+    def _getSettings(self, queries):
+        '''Values of the setting queries, from the cache while fresh.
+           The missing ones are fetched together'''
+        missing = self._staleSettings(queries)
+        if missing:
+            now = time.time()
+            for q, value in zip(missing, self._queryMany(missing)):
+                self._settings[q] = (float(value), now)
+        return [self._settings[q][0] for q in queries]
+    
+    def _staleSettings(self, queries):
+        '''The setting queries missing from the cache or too old'''
+        now = time.time()
+        max_age = self.settings_max_age
+        return [q for q in queries if q not in self._settings or
+                (max_age is not None and now - self._settings[q][1] > max_age)]
+    
+    def _waveformSettings(self, chan):
+        '''The setting queries _scaleWaveform needs for chan'''
+        queries = [":CHAN%d:SCAL?"%chan, ":CHAN%d:OFFS?"%chan]
+        queries.extend(RIGOL_TIMEBASE_QUERIES)
+        if self.deep_memory:
+            queries.append(RIGOL_SAMPLE_RATE_QUERY % chan)
+        return queries
+    
+    def _queryMany(self, queries):
+        '''Responses to several queries, in a single round trip when
+           batch_queries is set and the firmware answers compound queries'''
+        if self.batch_queries and len(queries) > 1:
+            resp = self._query(";".join(queries)).replace(";", " ").split()
+            if len(resp) == len(queries):
+                return resp
+            self.batch_queries = False  # not understood by this firmware
+        return [self.query(q, 20) for q in queries]
+    
+    # Coroutine versions of the I/O for ioloop.IOLoop, see usbtmc.py
+    
+    def _co_write(self, message, timeout=None):
+        try:
+            yield self.dev.co_write(message, timeout)
+        except OSError as e:
+            self._ioError("Write", e)
+    
+    def _co_read(self, numbytes=300, timeout=None):
+        try:
+            data = yield self.dev.co_read(numbytes, timeout)
+        except OSError as e:
+            self._ioError("Read", e)
+        raise Return(data)
+    
+    def _co_query(self, message, numbytes=300, timeout=None):
+        yield self._co_write(message, timeout)
+        data = yield self._co_read(numbytes, timeout)
+        raise Return(data)
+    
+    def _co_readBlock(self, chan):
+        length = self._blockLength((yield self._co_read(RIGOL_WAV_PREAMBLE_LENGTH)))
+        buf = self._getBuffer(chan, length)
+        n = 0
+        while n < length:
+            chunk = yield self._co_read(min(length - n, RIGOL_BLOCK_CHUNK))
+            n = self._storeChunk(chan, buf, n, chunk)
+        raise Return(buf)
+    
+    def _dropGrabSettings(self):
+        '''Forget the settings read again on every grab'''
+        for q in RIGOL_TIMEBASE_QUERIES:
+            self._settings.pop(q, None)
+        for chan in range(1, self.n_chans + 1):
+            self._settings.pop(RIGOL_SAMPLE_RATE_QUERY % chan, None)
     
     def _getVoltScale(self,chan=1):
-        return float(self.query(":CHAN"+str(chan)+":SCAL?", 20))
+        return self._getSettings((":CHAN"+str(chan)+":SCAL?",))[0]
 
     def _getVoltOffset(self,chan=1):
-        return float(self.query(":CHAN"+str(chan)+":OFFS?", 20))
+        return self._getSettings((":CHAN"+str(chan)+":OFFS?",))[0]
 
     def _getTimeScale(self):
-        return float(self.query(":TIM:SCAL?", 20))
+        return self._getSettings((":TIM:SCAL?",))[0]
 
     def _getTimeOffset(self):
         '''Time corresponding to screen center = sample 300'''
-        return float(self.query(":TIM:OFFS?", 20))            
+        return self._getSettings((":TIM:OFFS?",))[0]
         
     ##############################
     # Public Methods
     ##############################
+    def grabData(self):
+        '''Acquire data from scope and store in object.  The timebase is
+           read once per grab, the vertical settings come from the cache'''
+        self._dropGrabSettings()
+        Scope.grabData(self)
+    
+    def grabDataAsync(self):
+        '''Coroutine version of grabData() for an ioloop.IOLoop, so that
+           one thread can read several scopes while each waits on USB'''
+        self._dropGrabSettings()
+        for i in range(self.n_chans):
+            mask = 1 << i
+            if mask & self.active_channels:
+                chan = i + 1
+                for q in self._staleSettings(self._waveformSettings(chan)):
+                    value = yield self._co_query(q, 20)
+                    self._settings[q] = (float(value), time.time())
+                yield self._co_write(":WAV:DATA? CHAN%d" % chan)
+                buf = yield self._co_readBlock(chan)
+                self.channels[i].setChannelData(*self._scaleWaveform(chan, buf))
+                self.grabbed_channels |= mask
+        self._publish()
+    
+    def waitForTrigger(self, timeout=None):
+        '''Arm the scope with :RUN, which starts a new sweep in single
+           sweep mode, and poll :TRIG:STAT? until it goes from WAIT, RUN
+           or AUTO to triggered (T'D) or finished (STOP).  Both states
+           last, so only the transition counts and each acquisition is
+           seen once.  With deep memory it waits for STOP, the memory is
+           only read out while stopped.  The DS1000 has no service
+           request for this.  Returns False after timeout seconds, a
+           later call keeps waiting for the same sweep'''
+        if timeout is not None:
+            deadline = time.time() + timeout
+        if not self._armed:
+            # run control leaves the settings alone, keep them cached
+            try:
+                self.dev.write(":RUN", timeout)
+            except OSError as e:
+                self._ioError("Write", e)
+            self._armed = True
+            self._acquiring = False
+        done = ("STOP",) if self.deep_memory else ("T'D", "STOP")
+        while True:
+            if timeout is not None:
+                timeout = max(deadline - time.time(), self.trigger_poll)
+            status = self._query(":TRIG:STAT?", 20, timeout).strip().upper()
+            if status in done:
+                if self._acquiring:
+                    self._armed = False
+                    return True
+            else:
+                self._acquiring = True
+            if timeout is not None and time.time() + self.trigger_poll > deadline:
+                return False
+            time.sleep(self.trigger_poll)
+    
+    def invalidateSettings(self):
+        '''Drop the cached settings, e.g. after changing them on the front panel'''
+        self._settings.clear()
+    
     def stop(self):
         """Stop acquisition"""
         self._write(":STOP")
@@ -160,7 +356,7 @@ class RigolScope(Scope):
         self._write(":KEY:FORC")    
     def close(self):
         """Close interface to instrument and release file descriptor"""
-        os.close(self.FILE)
+        self.dev.close()
     
     ##############################
     #  Public Methods            #
@@ -173,6 +369,17 @@ class RigolScope(Scope):
             self.write(":ACQuire:TYPE NORMal")
         self.write(command)
     
+    def setDeepMemory(self, on=True):
+        '''Read the whole acquisition memory (up to 1M points) instead of
+           the 600 screen points.  The scope only hands out its memory
+           while stopped, so stop() it before grabData().  Set progress to
+           follow the download'''
+        self.deep_memory = on
+        if on:
+            self.write(":WAV:POIN:MODE MAX")
+        else:
+            self.write(":WAV:POIN:MODE NORM")
+    
     def setAverages(self, averages):
         if averages in [2,4, 8, 16, 32, 64, 128,256]:
             self.write(":ACQuire:AVERages %d"%averages)
@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#===========================================================
+#
+# This file is part of PyOscope
+#
+# synthetic.py
+#
+# Copyright (c) 2011 Michael Hadmack (michael.hadmack@gmail.com)
+# This code is distributed under the MIT license
+#
+# Scope driver which generates its waveforms, for load testing
+# the Scope -> listener -> writer -> plot pipeline without
+# hardware at production memory depths
+#===========================================================
+"""
+Each channel is a sum of signal models evaluated with numpy over the
+whole record, then quantized to the raw sample width like a real
+digitizer:
+
+    scope = SyntheticScope(n_chans=4, points=1000000, bits=8,
+                           latency=1e-3, bandwidth=1e6)
+    scope.setSignals(1, [Pulse(0.5, 0., 1e-6), Noise(0.01)])
+    scope.jitter = 1e-9
+
+The models which don't change between shots are rendered once and
+reused while the timebase and jitter allow it.
+"""
+import time
+import numpy as np
+from oscope import Scope
+
+class Sine(object):
+    '''amplitude*sin(2 pi frequency t + phase)'''
+    static = True
+
+    def __init__(self, amplitude, frequency, phase=0.):
+        self.amplitude = amplitude
+        self.frequency = frequency
+        self.phase = phase
+
+    def render(self, index, t0, dt, out, tmp):
+        w = 2*np.pi*self.frequency
+        np.multiply(index, w*dt, tmp)
+        tmp += w*t0 + self.phase
+        np.sin(tmp, tmp)
+        tmp *= self.amplitude
+        out += tmp
+
+class Pulse(object):
+    '''Rectangular pulse of amplitude from start for width seconds'''
+    static = True
+
+    def __init__(self, amplitude, start, width):
+        self.amplitude = amplitude
+        self.start = start
+        self.width = width
+
+    def render(self, index, t0, dt, out, tmp):
+        n = len(out)
+        i0 = min(max(int(np.ceil((self.start - t0)/dt)), 0), n)
+        i1 = min(max(int(np.ceil((self.start + self.width - t0)/dt)), 0), n)
+        out[i0:i1] += self.amplitude
+
+class Noise(object):
+    '''Gaussian noise of rms sigma.  A shot takes a window at a random
+       offset into a table twice the record length, so no random
+       numbers are drawn per shot'''
+    static = False
+
+    def __init__(self, sigma, seed=None):
+        self.sigma = sigma
+        self._random = np.random.RandomState(seed)
+        self._table = None
+
+    def render(self, index, t0, dt, out, tmp):
+        n = len(out)
+        if self._table is None or len(self._table) != 2*n:
+            self._table = self._random.normal(0., self.sigma, 2*n)
+        i = self._random.randint(n + 1)
+        out += self._table[i:i+n]
+
+class SyntheticScope(Scope):
+    '''Scope with n_chans channels of points samples each dt apart.
+       bits is the raw sample width, 8 or 16, spanning +/-volt_range.
+       latency is the emulated time per channel read in seconds and
+       bandwidth the transfer speed in bytes/s, None for instant.
+       jitter is the rms trigger jitter in seconds'''
+    def __init__(self, n_chans=4, points=10000, dt=1e-9, bits=8,
+                 volt_range=1., latency=0., bandwidth=None, jitter=0.,
+                 seed=None):
+        self.n_chans = n_chans  # for _idn, before Scope.__init__
+        self.points = points
+        self.sample_dt = dt
+        self.bits = bits
+        self.volt_range = volt_range
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.jitter = jitter
+        self._random = np.random.RandomState(seed)
+        self._signals = {}
+        self._buffers = {}  # chan: (raw, signal, tmp)
+        self._base = {}     # chan: ((t0, dt, n), static part of the signal)
+        self._index = None
+        self._shift = 0.    # trigger jitter of the acquisition being read
+        Scope.__init__(self, n_chans)
+        for chan in range(1, n_chans + 1):
+            self.setSignals(chan, [Pulse(0.5, -2e-7*chan, 2e-7*chan),
+                                   Sine(0.1, 1./(points*dt)*chan),
+                                   Noise(0.01, seed and seed + chan)])
+
+    ##############################
+    #  Required Overrides        #
+    ##############################
+    def _idn(self):
+        return "PyOscope,SyntheticScope,%d channels,%d bits" % (self.n_chans, self.bits)
+
+    def _readWaveform(self, chan=1):
+        n = self.points
+        dt = self.sample_dt
+        t0 = -n*dt/2    # trigger in the middle of the record
+        if self._index is None or len(self._index) != n:
+            self._index = np.arange(n, dtype=np.float64)
+        raw, signal, tmp = self._getBuffers(chan, n)
+        shift = self._shift
+        self._renderStatic(chan, t0 - shift, dt, signal, tmp)
+        for model in self._signals[chan]:
+            if not model.static:
+                model.render(self._index, t0 - shift, dt, signal, tmp)
+        # quantize like the digitizer
+        vert_gain = self.volt_range/(1 << (self.bits - 1))
+        np.multiply(signal, 1./vert_gain, tmp)
+        np.rint(tmp, tmp)
+        info = np.iinfo(raw.dtype)
+        np.clip(tmp, info.min, info.max, tmp)
+        raw[:] = tmp
+        self._transfer(raw.nbytes)
+        self.dt = dt
+        self.t0 = t0
+        self.size = n
+        return (raw, vert_gain, 0.)
+
+    def _writeWaveform(self, fo, header='', binary=False):
+        '''Time and the scaled waveform of every grabbed channel as
+           tab separated columns'''
+        chans = [i for i in range(self.n_chans) if (1 << i) & self.grabbed_channels]
+        fo.write(header)
+        fo.write("# DeviceId=" + self.name.strip() + '\n')
+        fo.write("# " + time.ctime(self.timestamp) + '\n')
+        fo.write("# " + ", ".join(["Chan%d: %g V/unit %+g V" % (i + 1,
+                 self.channels[i].volt_gain, self.channels[i].volt_offset)
+                 for i in chans]) + '\n')
+        fo.write("# Horiz: %g sec/sample, Trigger: %g sec\n"%(self.dt,self.t0))
+        fo.write("# Time (sec)     " +
+                 "".join(["\tChannel %d (V)" % (i + 1) for i in chans]) + '\n')
+        columns = [np.asarray(self.timeaxis)]
+        columns += [self.channels[i].getScaledWaveform(cached=True) for i in chans]
+        np.savetxt(fo, np.column_stack(columns), fmt="%1.4e" + "\t%1.3e"*len(chans))
+
+    ##############################
+    #  Private Methods           #
+    ##############################
+    def _getBuffers(self, chan, n):
+        dtype = np.dtype('i1' if self.bits <= 8 else 'i2')
+        buffers = self._buffers.get(chan)
+        if buffers is None or len(buffers[0]) != n or buffers[0].dtype != dtype:
+            buffers = self._buffers[chan] = (np.empty(n, dtype=dtype),
+                                             np.empty(n), np.empty(n))
+        return buffers
+
+    def _renderStatic(self, chan, t0, dt, signal, tmp):
+        '''Sum of the static models of chan into signal.  Without jitter
+           it is kept and reused while the timebase is unchanged'''
+        if self.jitter:
+            signal.fill(0.)
+            for model in self._signals[chan]:
+                if model.static:
+                    model.render(self._index, t0, dt, signal, tmp)
+            return
+        key = (t0, dt, len(self._index))
+        cached = self._base.get(chan)
+        if cached is None or cached[0] != key:
+            base = np.zeros(len(self._index))
+            for model in self._signals[chan]:
+                if model.static:
+                    model.render(self._index, t0, dt, base, tmp)
+            cached = self._base[chan] = (key, base)
+        signal[:] = cached[1]
+
+    def _transfer(self, nbytes):
+        '''Take as long as reading nbytes from a real scope would'''
+        delay = self.latency
+        if self.bandwidth:
+            delay += nbytes/float(self.bandwidth)
+        if delay > 0:
+            time.sleep(delay)
+
+    ##############################
+    # Public Methods
+    ##############################
+    def grabData(self):
+        '''One acquisition, all channels share its trigger jitter'''
+        self._shift = self._random.normal(0., self.jitter) if self.jitter else 0.
+        Scope.grabData(self)
+
+    def setSignals(self, chan, models):
+        '''The list of signal models summed up for chan'''
+        self._signals[chan] = list(models)
+        self._base.pop(chan, None)
+
+    def getSignals(self, chan):
+        return self._signals[chan]
+
+    def setMemorySize(self, points):
+        self.points = int(points)
+
+if __name__ == "__main__":
+    scope = SyntheticScope(points=1000000)
+    start = time.time()
+    for i in range(10):
+        scope.grabData()
+    print "%.1f ms per 4 x 1M point grab" % ((time.time() - start)*100)
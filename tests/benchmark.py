@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+#
+# PyOscope
+# benchmark.py
+#
+# Copyright (c) 2011 Mike Hadmack
+# This code is distributed under the MIT license
+#
+"""Headless end to end benchmarks against stand-in drivers
+
+    usage: python benchmark.py [-o results.json] [-d 600,10k,1M] [-r 5]
+
+Times each stage of an acquisition at several memory depths:
+  waverunner receive  Waverunner._readRawWaveform over enetsim (localhost)
+  wavedesc decode     WAVEDESC parse and byte order fix of the samples
+  rigol grab          RigolScope.grabData from an in-memory usbtmc stand-in
+  synthetic grab      SyntheticScope.grabData, the generator itself
+  scaled waveform     ScopeChannel.getScaledWaveform, float64 and float32
+  time axis           Scope._makeTimeAxis and the array built from it
+  write file          Waverunner.writeWaveformToFile to a temporary file
+  plot draw           wxoscope.ScopePlot.draw, skipped without wx/display
+
+The results are written as JSON, one record per stage and depth with
+the min/median/mean time, samples/s and bytes/s, so that runs of
+different versions can be compared.
+"""
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from optparse import OptionParser
+import numpy as np
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import enetsim
+from enetsim import parseSize
+from oscope import nativeOrder
+from rigol import RigolScope
+from synthetic import SyntheticScope
+from waverunner import Waverunner
+
+DEFAULT_DEPTHS = "600,10k,100k,1M,10M"
+
+class MemoryDevice(object):
+    '''Stand-in for UsbtmcDevice answering like a DS1000 in memory'''
+    def __init__(self, points):
+        data = (np.arange(points) % 200 + 25).astype('B').tostring()
+        self.block = "#8%08d" % points + data
+        self._out = ""
+
+    def write(self, message, timeout=None):
+        message = message.strip()
+        if message == "*IDN?":
+            self._out = "Rigol Technologies,DS1102E,BENCH,00.02.05\n"
+        elif message.startswith(":WAV:DATA?"):
+            self._out = self.block
+        elif message.endswith("?"):
+            self._out = "1.000e-03\n"
+
+    def read(self, num, timeout=None):
+        data, self._out = self._out[:num], self._out[num:]
+        return data
+
+    def close(self):
+        pass
+
+def timeit(func, repeat, setup=None):
+    '''Run func repeat times, each after setup, returns the times'''
+    times = []
+    for i in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.time()
+        func()
+        times.append(time.time() - start)
+    return times
+
+def record(results, name, points, nbytes, times):
+    times = sorted(times)
+    median = times[len(times)//2]
+    results.append({
+        "name": name,
+        "points": points,
+        "bytes": nbytes,
+        "repeat": len(times),
+        "min_s": times[0],
+        "median_s": median,
+        "mean_s": sum(times)/len(times),
+        "samples_per_s": points/median if median else None,
+        "bytes_per_s": nbytes/median if median and nbytes else None,
+    })
+    print "%-20s %9d pts  median %10.3f ms  %8.1f Msamples/s" % (
+        name, points, median*1e3, points/median/1e6 if median else 0.)
+
+def benchWaverunner(results, points, repeat, write_limit):
+    server = enetsim.startServer(instrument=lambda: enetsim.LecroySim(points=points))
+    scope = Waverunner("127.0.0.1", port=server.getPort(), points=points)
+    try:
+        scope.active_channels = 1
+        scope.grabData()    # settle the memory size and descriptor
+        nbytes = 2*points
+        record(results, "waverunner receive", points, nbytes,
+               timeit(lambda: scope._readRawWaveform(1), repeat))
+        buf, i = scope._readRawWaveform(1)
+        def decode():
+            data, gain, offset = scope._decodeWaveform(buf, i, 1)
+            nativeOrder(data)
+        record(results, "wavedesc decode", points, nbytes,
+               timeit(decode, repeat, scope._descriptors.clear))
+        if points <= write_limit:
+            fd, path = tempfile.mkstemp(suffix=".dat")
+            os.close(fd)
+            scope.active_channels = 3
+            scope.grabData()
+            record(results, "write file", points, 0,
+                   timeit(lambda: scope.writeWaveformToFile(path), repeat))
+            os.unlink(path)
+    finally:
+        scope.close()
+        server.shutdown()
+        server.server_close()
+
+def benchRigol(results, points, repeat):
+    scope = RigolScope(MemoryDevice(points))
+    scope.active_channels = 1
+    scope.grabData()
+    record(results, "rigol grab", points, points, timeit(scope.grabData, repeat))
+
+def benchSynthetic(results, points, repeat):
+    scope = SyntheticScope(n_chans=2, points=points)
+    scope.active_channels = 1
+    scope.grabData()
+    record(results, "synthetic grab", points, points, timeit(scope.grabData, repeat))
+    channel = scope.channels[0]
+    data, gain, offset = channel.data, channel.volt_gain, channel.volt_offset
+    reset = lambda: channel.setChannelData(data, gain, offset)
+    record(results, "scaled waveform", points, 8*points,
+           timeit(channel.getScaledWaveform, repeat, reset))
+    record(results, "scaled waveform f4", points, 4*points,
+           timeit(lambda: channel.getScaledWaveform(np.float32), repeat, reset))
+    def shift():
+        scope.t0 += scope.dt
+    record(results, "time axis", points, 0,
+           timeit(scope._makeTimeAxis, repeat, shift))
+    def timeAxisArray():
+        scope._makeTimeAxis()
+        np.asarray(scope.getTimeAxis())
+    record(results, "time axis array", points, 8*points,
+           timeit(timeAxisArray, repeat, shift))
+    return scope
+
+def benchPlot(results, skipped, points, repeat):
+    try:
+        import wx
+        app = wx.App(False)
+        from wxoscope import ScopePlot
+    except Exception as e:
+        skipped.append({"name": "plot draw", "points": points, "reason": str(e)})
+        return
+    scope = SyntheticScope(n_chans=2, points=points)
+    frame = wx.Frame(None)
+    plot = ScopePlot(frame, scope)
+    plot.draw()     # creates the axes
+    record(results, "plot draw", points, 0, timeit(plot.draw, repeat, scope.grabData))
+    frame.Destroy()
+
+def gitVersion():
+    try:
+        return subprocess.check_output(["git", "describe", "--always", "--dirty"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=open(os.devnull, 'w')).strip()
+    except Exception:
+        return None
+
+if __name__ == "__main__":
+    parser = OptionParser()
+    parser.add_option("-o", "--output", default="benchmark.json",
+                      help="JSON results file [default: %default]")
+    parser.add_option("-d", "--depths", default=DEFAULT_DEPTHS,
+                      help="Memory depths [default: %default]")
+    parser.add_option("-r", "--repeat", type="int", default=5,
+                      help="Runs per measurement [default: %default]")
+    parser.add_option("-w", "--write-limit", default="100k",
+                      help="Largest depth for the ASCII file writer [default: %default]")
+    parser.add_option("--no-plot", action="store_true", default=False,
+                      help="Skip ScopePlot.draw")
+    (options, args) = parser.parse_args()
+
+    depths = [parseSize(d) for d in options.depths.split(',')]
+    write_limit = parseSize(options.write_limit)
+    results = []
+    skipped = []
+    for points in depths:
+        benchWaverunner(results, points, options.repeat, write_limit)
+        benchRigol(results, points, options.repeat)
+        benchSynthetic(results, points, options.repeat)
+        if not options.no_plot:
+            benchPlot(results, skipped, points, options.repeat)
+    for s in skipped:
+        print "skipped %s at %d points: %s" % (s["name"], s["points"], s["reason"])
+
+    report = {
+        "version": gitVersion(),
+        "timestamp": time.time(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "repeat": options.repeat,
+        "results": results,
+        "skipped": skipped,
+    }
+    fo = open(options.output, 'w')
+    json.dump(report, fo, indent=1, sort_keys=True)
+    fo.close()
+    print "Results written to " + options.output
@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#===========================================================
+#
+# This file is part of PyOscope
+#
+# usbtmc.py
+#
+# Copyright (c) 2011 Michael Hadmack (michael.hadmack@gmail.com)
+# This code is distributed under the MIT license
+#
+# Access to a Linux usbtmc character device with per call
+# deadlines and coroutine versions of read/write
+#===========================================================
+"""
+The usbtmc driver does not support select() for data, a read blocks in
+the kernel until the instrument answers or the driver times out with
+ETIMEDOUT.  UsbtmcDevice sets the driver timeout to the deadline of each
+call.  Drivers older than 4.19 can't change it and have no poll(), so
+select() reports them ready at once.  There the read is handed to the
+device's helper thread, which is given the deadline; a read that overruns
+it is left to end with the driver's fixed timeout and its data is
+dropped.  The select() before it keeps the deadline for devices which do
+poll, such as a pty.
+
+The coroutine versions run on the same helper thread, which signals
+completion through a pipe, so that one ioloop.IOLoop can drive many
+devices:
+
+    loop = IOLoop()
+    for scope in scopes:
+        loop.spawn(scope.grabDataAsync())
+    loop.run()
+
+Timeouts raise OSError with errno ETIMEDOUT, as the driver does.
+"""
+import errno
+import fcntl
+import os
+import Queue
+import select
+import struct
+import sys
+import threading
+import time
+from ioloop import Return, READ, Sleep
+
+# _IOW('[', 10, __u32) from linux/usb/tmc.h, kernel 4.19 and later
+USBTMC_IOCTL_SET_TIMEOUT = 0x40045b0a
+USBTMC_DEFAULT_TIMEOUT = 5.     # driver default in s
+USBTMC_POLL = 0.005     # s between checks of a coroutine read on old drivers
+
+class _Call(object):
+    '''A blocking call run on the helper thread of a UsbtmcDevice'''
+    def __init__(self, func, args, notify):
+        self.func = func
+        self.args = args
+        self.notify = notify    # write a byte to the done pipe when finished
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+    def result(self):
+        if self.error is not None:
+            raise self.error[0], self.error[1], self.error[2]
+        return self.value
+
+def _timedOut():
+    return OSError(errno.ETIMEDOUT, os.strerror(errno.ETIMEDOUT))
+
+class UsbtmcDevice(object):
+    '''An open /dev/usbtmcN with deadlines in seconds for each call'''
+    def __init__(self, path, timeout=USBTMC_DEFAULT_TIMEOUT):
+        self.fd = os.open(path, os.O_RDWR)
+        self.timeout = timeout
+        self._set_timeout = True   # cleared if the driver has no ioctl for it
+        self._driver_timeout = None
+        self._pending = None    # call of the coroutine in progress
+        self._last = None       # last call on the helper thread
+        self._calls = Queue.Queue()
+        self._helper = None     # started with the first call
+        self._done_r, self._done_w = os.pipe()
+
+    def _setTimeout(self, timeout):
+        '''Set the driver timeout, if it can be changed'''
+        if timeout is None:
+            timeout = self.timeout
+        if not self._set_timeout or timeout == self._driver_timeout:
+            return
+        try:
+            fcntl.ioctl(self.fd, USBTMC_IOCTL_SET_TIMEOUT,
+                        struct.pack('I', max(int(timeout*1000), 1)))
+            self._driver_timeout = timeout
+        except IOError:
+            self._set_timeout = False   # older driver, fixed 5 s timeout
+
+    def _check(self):
+        if self._pending is not None:
+            raise IOError("asynchronous I/O in progress on usbtmc device")
+        if self._last is not None:
+            # the driver serves one transfer at a time, wait for a read
+            # which overran its deadline to time out in the driver
+            self._last.done.wait()
+            self._last = None
+
+    def _run(self):
+        while True:
+            call = self._calls.get()
+            if call is None:
+                break
+            try:
+                call.value = call.func(*call.args)
+            except Exception:
+                call.error = sys.exc_info()
+            call.done.set()
+            if call.notify:
+                os.write(self._done_w, 'x')
+
+    def _submit(self, func, args, notify=False):
+        '''Run func(*args) on the helper thread, returns the _Call'''
+        if self._helper is None:
+            self._helper = threading.Thread(target=self._run)
+            self._helper.daemon = True
+            self._helper.start()
+        call = self._last = _Call(func, args, notify)
+        self._calls.put(call)
+        return call
+
+    def write(self, message, timeout=None):
+        self._check()
+        self._setTimeout(timeout)
+        return os.write(self.fd, message)
+
+    def read(self, num, timeout=None):
+        '''Up to num bytes of the response.  Raises OSError ETIMEDOUT if
+           nothing arrives within timeout seconds'''
+        self._check()
+        self._setTimeout(timeout)
+        if self._set_timeout:
+            return os.read(self.fd, num)
+        if timeout is None:
+            timeout = self.timeout
+        deadline = time.time() + timeout
+        r, w, x = select.select([self.fd], [], [], timeout)
+        if not r:
+            raise _timedOut()
+        call = self._submit(os.read, (self.fd, num))
+        call.done.wait(max(deadline - time.time(), 0.))
+        if not call.done.is_set():
+            raise _timedOut()
+        self._last = None
+        return call.result()
+
+    def _co_finish(self, call):
+        yield (self._done_r, READ)
+        os.read(self._done_r, 1)
+        self._pending = self._last = None
+        raise Return(call.result())
+
+    def co_write(self, message, timeout=None):
+        '''Coroutine version of write()'''
+        self._check()
+        self._setTimeout(timeout)
+        self._pending = self._submit(os.write, (self.fd, message), True)
+        n = yield self._co_finish(self._pending)
+        raise Return(n)
+
+    def co_read(self, num, timeout=None):
+        '''Coroutine version of read()'''
+        self._check()
+        self._setTimeout(timeout)
+        if self._set_timeout:
+            self._pending = self._submit(os.read, (self.fd, num), True)
+            data = yield self._co_finish(self._pending)
+            raise Return(data)
+        # no poll() and no driver deadline: check the call between naps
+        if timeout is None:
+            timeout = self.timeout
+        deadline = time.time() + timeout
+        call = None
+        nap = 0.
+        while call is None or not call.done.is_set():
+            if time.time() >= deadline:
+                self._pending = None
+                raise _timedOut()
+            if call is None and select.select([self.fd], [], [], 0)[0]:
+                call = self._pending = self._submit(os.read, (self.fd, num))
+                nap = 0.
+            # short naps first, most reads finish right away
+            yield Sleep(min(nap, max(deadline - time.time(), 0.)))
+            nap = min(max(2*nap, 1e-4), USBTMC_POLL)
+        self._pending = self._last = None
+        raise Return(call.result())
+
+    def close(self):
+        self._calls.put(None)
+        os.close(self.fd)
+        os.close(self._done_r)
+        os.close(self._done_w)
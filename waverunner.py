@@ -23,25 +23,96 @@
 #  -  Standardize interface with pyusbtmc!
 #
 #===========================================================
-from libnienet import EnetLib
+from libnienet import EnetLib, CMPL, ERR, RQS, TIMO, tmoCode
 import time
 import sys
 import numpy as np
 import struct
-from oscope import Scope,OscopeError
+from oscope import Scope,ScopeSegments,OscopeError,OscopeTimeout
 import socket
 
 WAV_PREAMBLE_LENGTH = 22
-RAW_DATA_LENGTH = int(10e6)
+WAVEDESC_LENGTH = 346
+WAV_EXTRA_POINTS = 2  # the scope sends two more points than MEMORY_SIZE
+
+# LECROY_2_3 waveform descriptor, see the LeCroy Remote Control Manual.
+# Numbers are big endian (COMM_ORDER HI) unless COMM_ORDER is LO.
+WAVEDESC_DTYPE = np.dtype([
+    ('DESCRIPTOR_NAME', 'S16'), ('TEMPLATE_NAME', 'S16'),
+    ('COMM_TYPE', '>i2'), ('COMM_ORDER', '>i2'),
+    ('WAVE_DESCRIPTOR', '>i4'), ('USER_TEXT', '>i4'), ('RES_DESC1', '>i4'),
+    ('TRIGTIME_ARRAY', '>i4'), ('RIS_TIME_ARRAY', '>i4'), ('RES_ARRAY1', '>i4'),
+    ('WAVE_ARRAY_1', '>i4'), ('WAVE_ARRAY_2', '>i4'), ('RES_ARRAY2', '>i4'),
+    ('RES_ARRAY3', '>i4'),
+    ('INSTRUMENT_NAME', 'S16'), ('INSTRUMENT_NUMBER', '>i4'),
+    ('TRACE_LABEL', 'S16'), ('RESERVED1', '>i2'), ('RESERVED2', '>i2'),
+    ('WAVE_ARRAY_COUNT', '>i4'), ('PNTS_PER_SCREEN', '>i4'),
+    ('FIRST_VALID_PNT', '>i4'), ('LAST_VALID_PNT', '>i4'),
+    ('FIRST_POINT', '>i4'), ('SPARSING_FACTOR', '>i4'),
+    ('SEGMENT_INDEX', '>i4'), ('SUBARRAY_COUNT', '>i4'),
+    ('SWEEPS_PER_ACQ', '>i4'), ('POINTS_PER_PAIR', '>i2'),
+    ('PAIR_OFFSET', '>i2'), ('VERTICAL_GAIN', '>f4'),
+    ('VERTICAL_OFFSET', '>f4'), ('MAX_VALUE', '>f4'), ('MIN_VALUE', '>f4'),
+    ('NOMINAL_BITS', '>i2'), ('NOM_SUBARRAY_COUNT', '>i2'),
+    ('HORIZ_INTERVAL', '>f4'), ('HORIZ_OFFSET', '>f8'),
+    ('PIXEL_OFFSET', '>f8'), ('VERTUNIT', 'S48'), ('HORUNIT', 'S48'),
+    ('HORIZ_UNCERTAINTY', '>f4'),
+    ('TRIGGER_TIME', [('seconds', '>f8'), ('minutes', 'u1'), ('hours', 'u1'),
+                      ('days', 'u1'), ('months', 'u1'), ('year', '>i2'),
+                      ('unused', '>i2')]),
+    ('ACQ_DURATION', '>f4'), ('RECORD_TYPE', '>i2'),
+    ('PROCESSING_DONE', '>i2'), ('RESERVED5', '>i2'), ('RIS_SWEEPS', '>i2'),
+    ('TIMEBASE', '>i2'), ('VERT_COUPLING', '>i2'), ('PROBE_ATT', '>f4'),
+    ('FIXED_VERT_GAIN', '>i2'), ('BANDWIDTH_LIMIT', '>i2'),
+    ('VERTICAL_VERNIER', '>f4'), ('ACQ_VERT_OFFSET', '>f4'),
+    ('WAVE_SOURCE', '>i2')])
+
+# Byte ranges of the descriptor that change with every trigger:
+# HORIZ_OFFSET, TRIGGER_TIME and ACQ_DURATION.  Everything else is setup.
+_WAVEDESC_VOLATILE = [(180, 188), (296, 316)]
 
 def unpackLong(a, i):
-    return struct.unpack('>i', a[i:i+4])[0]
+    return struct.unpack_from('>i', a, i)[0]
     
 def unpackFloat(a, i):
-    return struct.unpack('>f', a[i:i+4])[0]
+    return struct.unpack_from('>f', a, i)[0]
     
 def unpackDouble(a, i):
-    return struct.unpack('>d', a[i:i+8])[0]
+    return struct.unpack_from('>d', a, i)[0]
+
+def parseWavedesc(buf, offset=0):
+    '''Decode the WAVEDESC block at buf[offset:] in one step.
+       Returns a numpy record with the fields of WAVEDESC_DTYPE'''
+    dtype = WAVEDESC_DTYPE
+    if struct.unpack_from('<h', buf, offset + 34)[0] == 1:   # COMM_ORDER LO
+        dtype = dtype.newbyteorder('<')
+    return np.frombuffer(buf, dtype, 1, offset)[0].copy()
+
+def blockLength(head):
+    '''Length of the data block announced by a "Cn:WF ALL,#9nnnnnnnnn"
+       style IEEE 488.2 block header'''
+    if head[-11:-9] != '#9':
+        raise OscopeError("Bad waveform block header %r" % head)
+    return int(head[-9:])
+
+def sampleDtype(desc):
+    '''numpy dtype of the samples described by the WAVEDESC record desc'''
+    if desc['COMM_TYPE'] == 0:
+        return np.dtype('i1')
+    elif desc['COMM_ORDER'] == 0:
+        return np.dtype('>i2')
+    else:
+        return np.dtype('<i2')
+
+def _setupKey(raw):
+    '''The setup part of a raw descriptor, for comparing descriptors'''
+    parts = []
+    start = 0
+    for a, b in _WAVEDESC_VOLATILE:
+        parts.append(raw[start:a])
+        start = b
+    parts.append(raw[start:])
+    return "".join(parts)
 
 class Waverunner(Scope):
     '''Class to control Lecroy Waverunner via GPIB interface'''
@@ -52,6 +123,16 @@ class Waverunner(Scope):
             self.ud = ud = l.ibdev(pad=pad, tmo=tmo)
         except socket.error as e:
             raise OscopeError("Error connecting to device: " + str(e))
+        self._bufpool = {}
+        self._descriptors = {}
+        # with data_only set only DAT1 is fetched while the setup is
+        # unchanged, the full descriptor every desc_refresh grabs
+        self.data_only = False
+        self.desc_refresh = 100
+        self._desc_age = {}
+        # receive channel N+1 with ibrda while channel N is being stored
+        self.overlap_reads = False
+        self._srq_enabled = False
         Scope.__init__(self, n_chans=4)
         
         # Set memory depth default (Note: For some reason this does not work on the first capture!, previous value is used instead)
@@ -62,6 +143,8 @@ class Waverunner(Scope):
     ##############################
     def _write(self,message):
         '''Returns status'''
+        if '?' not in message:
+            self.invalidateDescriptors()  # may have changed the setup
         return self.l.ibwrt(self.ud,message)
     
     def _read(self,numbytes):
@@ -81,41 +164,98 @@ class Waverunner(Scope):
         self._write("*RST")
 
     def _readWaveform(self, chan=1):
-        '''Read full waveform and header from the scope to produced a scaled waveform'''
-        buf = self._readRawWaveform(chan)
-        n_desc        = unpackLong(buf,36)
-        n_data_bytes  = unpackLong(buf,60)
-        name          = buf[76:92]
-        n_data        = unpackLong(buf,116)
-        #first_valid   = unpackLong(buf,124)
-        #last_valid    = unpackLong(buf,128)
-        vert_gain     = unpackFloat(buf,156)
-        vert_offset   = unpackFloat(buf,160)
-        horiz_interval= unpackFloat(buf,176)
-        horiz_offset  = unpackDouble(buf,180)
-        data = np.frombuffer(buf, dtype='>h', count = n_data - 2, offset=n_desc)
+        '''Read full waveform and header from the scope to produced a scaled waveform.
+           The header is parsed as soon as it arrives and the samples are
+           received straight into the channel's pooled sample buffer'''
+        if (self.data_only and chan in self._descriptors and
+                self._desc_age.get(chan, self.desc_refresh) < self.desc_refresh):
+            result = self._readDataOnly(chan)
+            if result is not None:
+                return result
+        self._desc_age.pop(chan, None)
+        length = self._requestBlock(chan)
+        s, reader = self.l.ibrd_stream(self.ud, length + 1)
+        with reader:
+            head = bytearray(WAVEDESC_LENGTH)
+            self._readInto(reader, head, chan)
+            skip, n, dtype, vert_gain, vert_offset = self._parseDescriptor(head, 0, chan)
+            self._desc_age[chan] = 0
+            reader.skip(skip - WAVEDESC_LENGTH)
+            nbytes = n*dtype.itemsize
+            buf = self._getBuffer(chan, nbytes)
+            self._readInto(reader, memoryview(buf)[:nbytes], chan)
+        self._checkRead(reader.sta, nbytes, nbytes, chan)
+        # wraps the pooled buffer, valid until the next read of chan
+        data = np.frombuffer(buf, dtype=dtype, count=n)
+        return (data, vert_gain, vert_offset)
+
+    def _readDataOnly(self, chan):
+        '''Fetch only the DAT1 block of chan and reuse its last descriptor.
+           t0 keeps the HORIZ_OFFSET of that descriptor.  Returns None when
+           the block size shows the setup has changed'''
+        raw, key, info = self._descriptors[chan]
+        skip, n, dtype, vert_gain, vert_offset, horiz_interval, dfmt, wave_bytes = info
+        length = self._requestBlock(chan, "DAT1")
+        s, reader = self.l.ibrd_stream(self.ud, length + 1)
+        with reader:
+            if length != wave_bytes:
+                return None
+            nbytes = n*dtype.itemsize
+            buf = self._getBuffer(chan, nbytes)
+            self._readInto(reader, memoryview(buf)[:nbytes], chan)
+        self._checkRead(reader.sta, nbytes, nbytes, chan)
+        self._desc_age[chan] += 1
+        self.dt = horiz_interval
+        self.t0 = struct.unpack_from(dfmt, raw, 180)[0]
+        self.size = n
+        # wraps the pooled buffer, valid until the next read of chan
+        data = np.frombuffer(buf, dtype=dtype, count=n)
+        return (data, vert_gain, vert_offset)
+
+    def _decodeWaveform(self, buf, i, chan):
+        '''Decode a WAVEDESC block and the samples following it at buf[i:]'''
+        skip, n, dtype, vert_gain, vert_offset = self._parseDescriptor(buf, i, chan)
+        # wraps buf, valid until buf is reused
+        data = np.frombuffer(buf, dtype=dtype, count=n, offset=i+skip)
+        return (data, vert_gain, vert_offset)
+
+    def _parseDescriptor(self, buf, i, chan):
+        '''Read the WAVEDESC block at buf[i:] and set dt, t0 and size.
+           The setup fields are only decoded when they differ from the last
+           descriptor of chan.  Returns the offset of the samples from the
+           start of the block, the number of samples, their dtype and the
+           vertical gain and offset'''
+        raw = str(buf[i:i+WAVEDESC_LENGTH])
+        key = _setupKey(raw)
+        cached = self._descriptors.get(chan)
+        if cached is None or cached[1] != key:
+            desc = parseWavedesc(raw)
+            dtype = sampleDtype(desc)
+            skip = (desc['WAVE_DESCRIPTOR'] + desc['USER_TEXT'] +
+                    desc['TRIGTIME_ARRAY'] + desc['RIS_TIME_ARRAY'])
+            n = desc['WAVE_ARRAY_COUNT'] - WAV_EXTRA_POINTS
+            info = (int(skip), int(n), dtype, float(desc['VERTICAL_GAIN']),
+                    float(desc['VERTICAL_OFFSET']), float(desc['HORIZ_INTERVAL']),
+                    '<d' if desc['COMM_ORDER'] else '>d', int(desc['WAVE_ARRAY_1']))
+        else:
+            info = cached[2]
+        self._descriptors[chan] = (raw, key, info)
+        skip, n, dtype, vert_gain, vert_offset, horiz_interval, dfmt, wave_bytes = info
         
         self.dt = horiz_interval
-        self.t0 = horiz_offset
-        self.size = n_data - 2
+        self.t0 = struct.unpack_from(dfmt, raw, 180)[0]  # HORIZ_OFFSET
+        self.size = n
         
-        return (data, vert_gain, vert_offset) 
-
-    def _makeTimeAxis(self):
-        """Retrieve timescale and offset from the scope and return an array or
-           time points corresponding to the present scope trace
-           Units are seconds by default
-           Returns a numpy array of time points"""
-        self.timeaxis = np.arange(self.size)*self.dt + self.t0
-    
+        return (skip, n, dtype, vert_gain, vert_offset)
+
     def _writeWaveform(self, fo, header='', binary=False):
         # FIXME = add support for four channels
         data1 = np.zeros(self.size)
         data2 = np.zeros(self.size)
         if self.grabbed_channels | 1:
-            data1 = self.channels[0].getScaledWaveform()
+            data1 = self.channels[0].getScaledWaveform(cached=True)
         if self.grabbed_channels | 2:
-            data2 = self.channels[1].getScaledWaveform()
+            data2 = self.channels[1].getScaledWaveform(cached=True)
         
         fo.write(header)
         fo.write("# DeviceId=" + self.name.strip() + '\n')
@@ -142,6 +282,77 @@ class Waverunner(Scope):
             [500,1000,2500,5000,10k,25k,50k,100k,250k,500k]'''
         self._write("MEMORY_SIZE %s"%samples)
         
+    def getDescriptor(self, chan=1):
+        '''The complete WAVEDESC of the last waveform read from chan as a
+           numpy record, e.g. getDescriptor(1)['TRIGGER_TIME']'''
+        if chan not in self._descriptors:
+            raise OscopeError("No waveform read from channel %d yet"%chan)
+        return parseWavedesc(self._descriptors[chan][0])
+
+    def setSequence(self, segments, points=None):
+        '''Acquire segments triggers per acquisition in sequence mode,
+           optionally with points samples per segment.  segments < 2
+           turns sequence mode off'''
+        if segments < 2:
+            self._write("SEQUENCE OFF")
+        elif points is None:
+            self._write("SEQUENCE ON,%d"%segments)
+        else:
+            self._write("SEQUENCE ON,%d,%s"%(segments, points))
+
+    def grabSequence(self, timeout=60.):
+        '''Arm once, wait up to timeout seconds until all segments are
+           acquired and read each active channel in a single transfer.
+           Returns {chan: ScopeSegments}, also kept in self.sequences.
+           They are not published to listeners or channel history'''
+        self._write("ARM;WAIT;*OPC?")
+        deadline = time.time() + timeout
+        while True:
+            s, resp = self._read(256)
+            if not s & ERR:
+                break
+            if time.time() > deadline:
+                raise OscopeError("Timeout waiting for sequence acquisition")
+        self.sequences = {}
+        for i in range(self.n_chans):
+            if (1 << i) & self.active_channels:
+                self.sequences[i+1] = self._readSequence(i+1)
+        return self.sequences
+
+    def waitForTrigger(self, timeout=None):
+        '''Wait for the service request the scope sends for each new
+           acquisition (INR bit 0 enabled with INE, INB with *SRE).
+           Returns False if none comes within timeout seconds, by
+           default the GPIB timeout'''
+        if not self._srq_enabled:
+            self._write("INE 1;*SRE 1")
+            self._srq_enabled = True
+        tmo = self.l.getSocket(self.ud).tmo
+        wait_tmo = tmo if timeout is None else tmoCode(timeout)
+        if wait_tmo != tmo:
+            self.l.ibtmo(self.ud, wait_tmo)
+        try:
+            sta = self.l.ibwait(self.ud, RQS | TIMO)
+        finally:
+            if wait_tmo != tmo:
+                self.l.ibtmo(self.ud, tmo)
+        if not sta & RQS:
+            return False
+        self.l.ibrsp(self.ud)   # serial poll clears RQS
+        self._query("INR?")     # and reading INR the new signal bit
+        return True
+
+    def invalidateDescriptors(self):
+        '''Make the next grab of every channel fetch its full descriptor.
+           Called for every command sent; call it after changing the
+           setup on the front panel when using data_only'''
+        self._desc_age.clear()
+
+    def setCommFormat(self, word=True):
+        '''Transfer samples as 16 bit words (default) or as single bytes,
+           which halves the transfer at the cost of resolution'''
+        self._write("COMM_FORMAT DEF9,%s,BIN" % ("WORD" if word else "BYTE"))
+
     def getMemorySize(self):
         '''Returns a string which needs to have SI suffix processed'''
         resp = self._query("MEMORY_SIZE?").split()[1]
@@ -149,15 +360,140 @@ class Waverunner(Scope):
 
     def close(self):
         self.l._close(self.ud)
+
+    def grabData(self):
+        '''Acquire data from scope and store in object.  With overlap_reads
+           set the next channel is transferred while the last one is stored'''
+        if not self.overlap_reads:
+            return Scope.grabData(self)
+        pending = None
+        try:
+            for i in range(self.n_chans):
+                mask = 1 << i
+                if mask & self.active_channels:
+                    done = None
+                    if pending:
+                        self._waitRead(*pending)
+                        done = pending
+                    pending = (i + 1,) + self._startRead(i + 1)
+                    if done:
+                        self._storeRead(*done)
+            if pending:
+                self._waitRead(*pending)
+                self._storeRead(*pending)
+        except Exception:
+            # a transfer left running would block every later command
+            self.l.ibstop(self.ud)
+            raise
+        self._publish()
+
+    def grabDataAsync(self):
+        '''Coroutine version of grabData() for an ioloop.IOLoop, so that
+           several scopes can transfer their waveforms at the same time'''
+        sock = self.l.getSocket(self.ud)
+        for i in range(self.n_chans):
+            mask = 1 << i
+            if mask & self.active_channels:
+                chan = i + 1
+                yield sock.co_ibwrt("C%d:WAVEFORM? ALL"%chan)
+                head = yield sock.co_ibrd(len("C%d:WF ALL,#9"%chan) + 9)
+                length = blockLength(head)
+                buf = self._getBuffer(chan, length + 1)
+                n = yield sock.co_ibrd_into(buf, length + 1)
+                self._checkRead(sock.sta, n, length, chan)
+                self.channels[i].setChannelData(*self._decodeWaveform(buf, 0, chan))
+                self.grabbed_channels |= mask
+        self._publish()
     
     ##############################
     #  Private Methods           #
     ##############################
+    def _getBuffer(self, chan, size):
+        '''Receive buffer for chan from the pool, reused between grabs'''
+        buf = self._bufpool.get(chan)
+        if buf is None or len(buf) < size:
+            buf = self._bufpool[chan] = bytearray(size)
+        return buf
+
+    def _requestBlock(self, chan, part="ALL"):
+        '''First phase of a waveform read: send Cn:WAVEFORM? part and read
+           only the "Cn:WF part,#9nnnnnnnnn" header.  Returns the length of
+           the block, which is followed by a newline'''
+        self._write("C%d:WAVEFORM? %s"%(chan, part))
+        s, head = self._read(len("C%d:WF %s,#9"%(chan, part)) + 9)
+        return blockLength(head)
+
+    def _checkRead(self, sta, n, num, chan):
+        '''Raise if a read of chan ended in an error or returned fewer
+           than the num bytes announced by the block header'''
+        if sta & TIMO:
+            raise OscopeTimeout("Timeout reading channel %d"%chan)
+        if sta & ERR:
+            raise OscopeError("Error reading channel %d"%chan)
+        if n < num:
+            raise OscopeError("Channel %d: waveform ended after %d of %d bytes"%(chan, n, num))
+
+    def _readInto(self, reader, buf, chan):
+        '''Fill buf from an EnetReader, the reply must not end before'''
+        n = reader.readinto(buf)
+        if n < len(buf):
+            self._checkRead(reader.sta, n, len(buf), chan)
+
     def _readRawWaveform(self, chan=1):
-        self._write("C%d:WAVEFORM? ALL"%chan)
-        s,buf = self._read(RAW_DATA_LENGTH)
-        return buf[21:-1] 
+        '''Returns the pooled buffer holding the WAVEDESC block and the
+           samples, read in two phases so the buffer fits the reply'''
+        length = self._requestBlock(chan)
+        buf = self._getBuffer(chan, length + 1)
+        s,n = self.l.ibrd_into(self.ud, buf, length + 1)
+        self._checkRead(s, n, length, chan)
+        return buf, 0
     
+    def _readSequence(self, chan):
+        '''Read all segments of chan into a (segments, points) array'''
+        length = self._requestBlock(chan)
+        s, reader = self.l.ibrd_stream(self.ud, length + 1)
+        with reader:
+            head = bytearray(WAVEDESC_LENGTH)
+            self._readInto(reader, head, chan)
+            desc = parseWavedesc(head)
+            dtype = sampleDtype(desc)
+            e = '<' if desc['COMM_ORDER'] else '>'
+            segments = max(int(desc['SUBARRAY_COUNT']), 1)
+            points = int(desc['WAVE_ARRAY_COUNT'])/segments
+            reader.skip(desc['WAVE_DESCRIPTOR'] - WAVEDESC_LENGTH + desc['USER_TEXT'])
+            trig = np.zeros(segments, dtype=[('time', e+'f8'), ('offset', e+'f8')])
+            if desc['TRIGTIME_ARRAY']:
+                self._readInto(reader, trig.view(np.uint8), chan)
+                reader.skip(desc['TRIGTIME_ARRAY'] - trig.nbytes)
+            else:
+                trig['offset'] = desc['HORIZ_OFFSET']
+            reader.skip(desc['RIS_TIME_ARRAY'])
+            data = np.empty((segments, points), dtype=dtype)
+            self._readInto(reader, data.view(np.uint8).reshape(-1), chan)
+        self._checkRead(reader.sta, data.nbytes, data.nbytes, chan)
+        return ScopeSegments(chan, data, float(desc['VERTICAL_GAIN']),
+                             float(desc['VERTICAL_OFFSET']),
+                             float(desc['HORIZ_INTERVAL']), trig['time'],
+                             trig['offset'], time.time())
+
+    def _startRead(self, chan):
+        '''Request chan and start receiving it in the background.
+           Returns the buffer and the length of the block'''
+        length = self._requestBlock(chan)
+        buf = self._getBuffer(chan, length + 1)
+        self.l.ibrda(self.ud, buf, length + 1)
+        return buf, length
+
+    def _waitRead(self, chan, buf, length):
+        sta = self.l.ibwait(self.ud, CMPL)
+        if not sta & CMPL:
+            raise OscopeTimeout("Timeout reading channel %d"%chan)
+        self._checkRead(sta, self.l.getSocket(self.ud).cnt, length, chan)
+
+    def _storeRead(self, chan, buf, length):
+        self.channels[chan-1].setChannelData(*self._decodeWaveform(buf, 0, chan))
+        self.grabbed_channels |= 1 << (chan-1)
+
     def _queryValue(self, message, numbytes=256):
         '''_query modified to extract parameters from Lecroy output string'''
         resp = self._query(message, numbytes).split()
@@ -28,6 +28,7 @@ try:
 except:
     import utils
 from wxPlotPanel import PlotPanel
+from oscope import AcquisitionWorker
 
 DELAY = 100 #ms
 DATA_ROOT = "/var/local/data"
@@ -42,6 +43,7 @@ class ScopePlot(PlotPanel):
         self.scope = scope
         self.tscale=1.0
         self.autoscaledata = True
+        self.frame = None   # ScopeFrame to show instead of the scope data
         self.scope.grabData() # just to get things started
         self._updateflag = False
         
@@ -58,9 +60,10 @@ class ScopePlot(PlotPanel):
             self.draw()
         
     def draw(self):
-        y1 = self.scope.getScaledWaveform(1)
-        y2 = self.scope.getScaledWaveform(2)
-        t_raw = self.scope.getTimeAxis()
+        source = self.frame or self.scope
+        y1 = source.getScaledWaveform(1, np.float32)
+        y2 = source.getScaledWaveform(2, np.float32)
+        t_raw = source.getTimeAxis()
         
         tdiv = t_raw[-1]-t_raw[0]/12 # assumes 12 division across scope
         if tdiv < 1e-6:
@@ -77,7 +80,7 @@ class ScopePlot(PlotPanel):
             xlabel = "Time (sec)"
         
         self.tscale = xscale
-        t = t_raw*self.tscale
+        t = np.asarray(t_raw*self.tscale)
         
         if not hasattr(self, 'ax1'):
             self.ax1 = self.figure.add_subplot(111)
@@ -108,8 +111,14 @@ class ScopePlot(PlotPanel):
         
     def on_scope_update(self, data):
         ''' When the data changes do something '''
-        self._updateflag = True
+        if self.frame is None:
+            self._updateflag = True
         #self.draw()
+    
+    def showFrame(self, frame):
+        '''Draw frame from an AcquisitionWorker, None to go back to the scope'''
+        self.frame = frame
+        self._updateflag = True
         
     def setAutoscaling(self, onff=True):
         self.autoscaledata = onff
@@ -119,6 +128,10 @@ class ScopePlotTestFrame(wx.Frame):
         wx.Frame.__init__(self, None, -1, "Scope Plot Test")
         self.scope = scope
         self.running = False
+        # grabData runs on this thread once per trigger, at most once per
+        # DELAY as scopes without triggers (Dummy, Synthetic) never wait
+        self.worker = AcquisitionWorker(scope, maxsize=2, interval=DELAY/1000.,
+                                      wait_trigger=True)
         panel = wx.Panel(self,-1)
         
         # Setup up control panel
@@ -145,6 +158,7 @@ class ScopePlotTestFrame(wx.Frame):
 
         self.timer = wx.Timer(self, -1)
         self.Bind(wx.EVT_TIMER, self.on_timer, self.timer)
+        self.Bind(wx.EVT_CLOSE, self.on_close)
 
     def createButton(self, parent, sizer, label, action):
         if not hasattr(self, 'buttons'):
@@ -155,20 +169,31 @@ class ScopePlotTestFrame(wx.Frame):
         self.buttons[label] = btn
             
     def on_timer(self, e):
-        self.scope.grabData()
+        frame = self.worker.getLatest()
+        if frame is not None:
+            self.plot.showFrame(frame)
 
     def on_force(self, e):
-        self.scope.grabData()
+        if not self.running:
+            self.plot.showFrame(None)
+            self.scope.grabData()
         
     def on_run(self, e):
         if self.running:
             self.running = False
             self.timer.Stop()
+            self.worker.stop()
             self.buttons["Run"].SetLabel("Run")
         else:
             self.running = True
+            self.worker.start()
             self.timer.Start(DELAY)
             self.buttons["Run"].SetLabel("Stop")
+    
+    def on_close(self, e):
+        self.timer.Stop()
+        self.worker.stop()
+        e.Skip()
 
     def on_save(self, e):
         filepath = utils.makeDataFilePath(DATA_ROOT, 'oscope')
@@ -182,12 +207,17 @@ class ScopePlotTestFrame(wx.Frame):
                                 defaultFile=filename, style=wx.SAVE)
         if dialog.ShowModal() == wx.ID_OK:
             filepath = dialog.GetPath()
-            self.scope.writeWaveformToFile(filepath, header)
+            self.save(filepath)
         dialog.Destroy() 
    
     def save(self,filename):
         header = ''
+        # the file is written from the scope, keep the worker off it
+        running = self.worker.isRunning()
+        self.worker.stop()
         self.scope.writeWaveformToFile(filename, header)
+        if running:
+            self.worker.start()
 
 if __name__ == '__main__':
     app = wx.PySimpleApp()
@@ -204,6 +234,9 @@ if __name__ == '__main__':
     elif device == 'dummy':
          from oscope import DummyScope
          scope = DummyScope()
+    elif device == 'synthetic':
+         from synthetic import SyntheticScope
+         scope = SyntheticScope(n_chans=2, points=100000)
 
     app.frame = ScopePlotTestFrame(scope)
     app.frame.Show()